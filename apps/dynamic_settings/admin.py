@@ -2,6 +2,7 @@ from constance.admin import ConstanceAdmin, Config
 from django.contrib import admin
 
 from apps.dynamic_settings.forms import CustomConstanceAdminForm
+from apps.dynamic_settings.utils import DynamicSettingsUtils
 
 
 class CustomConstanceAdmin(ConstanceAdmin):
@@ -10,6 +11,12 @@ class CustomConstanceAdmin(ConstanceAdmin):
     def has_change_permission(self, request, obj=None):
         return request.user.is_superuser or request.user.is_staff
 
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        if request.method == 'POST' and response.status_code == 302:  # the form was saved
+            DynamicSettingsUtils.bump_settings_version()
+        return response
+
 
 if admin.site.is_registered(Config):
     admin.site.unregister([Config])
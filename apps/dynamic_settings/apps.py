@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class DynamicSettingsConfig(AppConfig):
     name = 'apps.dynamic_settings'
+
+    def ready(self):
+        from constance.signals import config_updated
+        from apps.dynamic_settings.utils import DynamicSettingsUtils
+        config_updated.connect(DynamicSettingsUtils.bump_settings_version,
+                               dispatch_uid='dynamic_settings_bump_settings_version')
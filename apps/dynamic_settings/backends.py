@@ -0,0 +1,36 @@
+from types import MappingProxyType
+
+from constance import settings
+from constance.backends.database import DatabaseBackend
+
+from apps.dynamic_settings.utils import DynamicSettingsUtils, SettingsSnapshot
+
+
+class SnapshotDatabaseBackend(DatabaseBackend):
+    """
+    Constance database backend which loads all the keys with one query into a read-only mapping per process.
+    The mapping is reloaded when the settings version changes (every save of a constance value bumps it)
+    or after settings.DYNAMIC_SETTINGS_SNAPSHOT_TTL seconds. The version is read from the cache at most once per
+    settings.DYNAMIC_SETTINGS_VERSION_CHECK_INTERVAL seconds, so reading a dynamic setting is a dict lookup.
+    """
+    def __init__(self):
+        self._snapshot = SettingsSnapshot(self._load)
+        super().__init__()
+
+    def _load(self):
+        return MappingProxyType(dict(super().mget(settings.CONFIG)))
+
+    def mget(self, keys):
+        values = self._snapshot.get()
+        for key in keys or ():
+            if key in values:
+                yield key, values[key]
+
+    def get(self, key):
+        return self._snapshot.get().get(key)
+
+    def clear(self, sender, instance, created, **kwargs):
+        """ post_save receiver of the Constance model, so admin saves and config.X = value are both covered """
+        super().clear(sender, instance, created, **kwargs)
+        DynamicSettingsUtils.bump_settings_version()
+        self._snapshot.clear()
@@ -1,7 +1,12 @@
 import datetime
 from collections import OrderedDict
 
-CONSTANCE_BACKEND = 'constance.backends.database.DatabaseBackend'
+CONSTANCE_BACKEND = 'apps.dynamic_settings.backends.SnapshotDatabaseBackend'
+
+# seconds a process serves its settings snapshots without reloading, in case the version bump is not visible to it
+DYNAMIC_SETTINGS_SNAPSHOT_TTL = 60
+# seconds a process uses the settings version without reading it from the shared cache again
+DYNAMIC_SETTINGS_VERSION_CHECK_INTERVAL = 2
 
 # That's the main settings dict for the project.
 # You don't really have to change anything else in this file.
@@ -1,6 +1,6 @@
 import graphene
 
-from apps.dynamic_settings.utils import DynamicSettingsUtils
+from apps.dynamic_settings.utils import DynamicSettingsUtils, SettingsSnapshot
 from apps.general.graphql import construct_dynamic_graphene_object, python_type_to_graphql_type
 
 
@@ -17,13 +17,20 @@ DynamicSettingsType = construct_dynamic_graphene_object(
 )
 
 
+def _build_site_settings():
+    keys_dict = {}
+    for c_key, c_value in DynamicSettingsUtils.get_public_dynamic_settings().items():
+        keys_dict[c_key.lower().capitalize()] = c_value
+    for c_key, c_value in DynamicSettingsUtils.get_public_settings().items():
+        keys_dict[c_key.lower().capitalize()] = c_value
+    return DynamicSettingsType(**keys_dict)
+
+
+site_settings_snapshot = SettingsSnapshot(_build_site_settings)
+
+
 class Query(graphene.AbstractType):
     site_settings = graphene.Field(DynamicSettingsType)
 
     def resolve_site_settings(self, args, context, info):
-        keys_dict = {}
-        for c_key, c_value in DynamicSettingsUtils.get_public_dynamic_settings().items():
-            keys_dict[c_key.lower().capitalize()] = c_value
-        for c_key, c_value in DynamicSettingsUtils.get_public_settings().items():
-            keys_dict[c_key.lower().capitalize()] = c_value
-        return DynamicSettingsType(**keys_dict)
+        return site_settings_snapshot.get()
@@ -1,26 +1,53 @@
 import datetime
+from contextlib import contextmanager
+from unittest.mock import patch
 
 import graphene
 from constance import config
+from constance.admin import get_values
 from django.contrib.auth.models import Group
-from django.test import TestCase, RequestFactory
+from django.core.cache import CacheHandler
+from django.core.exceptions import ValidationError
+from django.core.management.commands.createcachetable import Command as CreateCacheTableCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.test import TestCase, RequestFactory, override_settings
 from django.urls import reverse
 from graphene.test import Client
 from model_mommy import mommy
 
 from apps.account.models import ProxyUser
+from apps.dynamic_settings import schema as app_schema
 from apps.dynamic_settings.constance_settings import CONSTANCE_CONFIG
+from apps.dynamic_settings.forms import CustomConstanceAdminForm
+from apps.dynamic_settings.typed_settings import get_typed_setting, parse_email_amounts, typed_settings_snapshot
 from apps.dynamic_settings.utils import DynamicSettingsUtils
 from apps.general.graphql import format_error
 from apps.property.models import PropertyManagementCompany, CustomerSegment, Property, PropertyContract
 from apps.resident.models import Resident
 
 
+DATABASE_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'test_dynamic_settings_cache',
+    }
+}
+
+
+@contextmanager
+def database_cache():
+    """ The production cache backend. `override_settings` doesn't rebuild `cache`, so it's patched """
+    with override_settings(CACHES=DATABASE_CACHES):
+        CreateCacheTableCommand().create_table(DEFAULT_DB_ALIAS, DATABASE_CACHES['default']['LOCATION'], False)
+        with patch('apps.dynamic_settings.utils.cache', CacheHandler()['default']), \
+                patch.object(DynamicSettingsUtils, '_settings_version', (None, None)):
+            DynamicSettingsUtils.bump_settings_version()
+            yield
+
+
 class DynamicSettingsTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
-        from apps.dynamic_settings import schema as app_schema
-
         class TestQuery(app_schema.Query, graphene.ObjectType):
             pass
 
@@ -42,6 +69,8 @@ class DynamicSettingsTestCase(TestCase):
         self.request = RequestFactory().post(reverse('graphql_endpoint'))
         self.request.user = self.user
         self._reset_constance_settings_to_default()
+        app_schema.site_settings_snapshot.clear()
+        typed_settings_snapshot.clear()
 
     def test_get_public_dynamic_settings(self):
         query = """
@@ -74,6 +103,77 @@ class DynamicSettingsTestCase(TestCase):
                 is_error = True
         self.assertTrue(is_error)
 
+    def test_site_settings_snapshot(self):
+        query = """
+            query q {
+                siteSettings {
+                    ConciergeEmail
+                }
+            }
+        """
+        self._execute_site_settings_api_schema(req_string=query, context=self.request)
+        with self.assertNumQueries(0):
+            site_settings = self._execute_site_settings_api_schema(req_string=query, context=self.request)
+        self.assertEqual(site_settings, {'ConciergeEmail': 'concierge@whatsmycut.com'})
+
+        config.CONCIERGE_EMAIL = 'new@whatsmycut.com'
+        DynamicSettingsUtils.bump_settings_version()
+        site_settings = self._execute_site_settings_api_schema(req_string=query, context=self.request)
+        self.assertEqual(site_settings, {'ConciergeEmail': 'new@whatsmycut.com'})
+
+    def test_site_settings_snapshot_with_database_cache(self):
+        query = """
+            query q {
+                siteSettings {
+                    ConciergeEmail
+                }
+            }
+        """
+        with database_cache():
+            self._execute_site_settings_api_schema(req_string=query, context=self.request)
+            with self.assertNumQueries(0):
+                for _ in range(3):
+                    site_settings = self._execute_site_settings_api_schema(req_string=query, context=self.request)
+            self.assertEqual(site_settings, {'ConciergeEmail': 'concierge@whatsmycut.com'})
+
+    def test_snapshot_database_backend(self):
+        config.CONCIERGE_PHONE = '555-0100'
+        self.assertEqual(config.CONCIERGE_EMAIL, 'concierge@whatsmycut.com')  # loads the snapshot
+        with self.assertNumQueries(0):
+            self.assertEqual(config.CONCIERGE_PHONE, '555-0100')
+            self.assertEqual(config.CONCIERGE_EMAIL, 'concierge@whatsmycut.com')
+
+        config.CONCIERGE_PHONE = '555-0199'
+        self.assertEqual(config.CONCIERGE_PHONE, '555-0199')
+
+    def test_snapshot_database_backend_with_database_cache(self):
+        with database_cache():
+            self.assertEqual(config.CONCIERGE_EMAIL, 'concierge@whatsmycut.com')  # loads the snapshot
+            with self.assertNumQueries(0):
+                for _ in range(3):
+                    self.assertEqual(config.CONCIERGE_EMAIL, 'concierge@whatsmycut.com')
+            with override_settings(DYNAMIC_SETTINGS_VERSION_CHECK_INTERVAL=0), self.assertNumQueries(1):
+                self.assertEqual(config.CONCIERGE_EMAIL, 'concierge@whatsmycut.com')  # reads the version only
+
+    def test_typed_settings(self):
+        config.NO_PRICES_NOTIFICATION_RECIPIENTS = 'a@a.com, invalid, b@b.com'
+        config.STRIPE_EXTRA_CUSTOMER_BALANCE_PER_EMAIL = 'a@a.com=5$, b@b.com=15$'
+        self.assertEqual(DynamicSettingsUtils.get_no_prices_notification_recipients(), ['a@a.com', 'b@b.com'])
+        self.assertEqual(get_typed_setting('DAYS_BETWEEN_ACTIVATION_EMAILS'), (4, 4, 4))
+        self.assertEqual(dict(get_typed_setting('STRIPE_EXTRA_CUSTOMER_BALANCE_PER_EMAIL')),
+                         {'a@a.com': 5, 'b@b.com': 15})
+        with self.assertRaises(ValidationError):
+            parse_email_amounts('a@a.com=5$, b@b.com')
+
+    def test_admin_form_validates_typed_settings(self):
+        initial = get_values()
+        data = {key: value for key, value in initial.items() if value is not False}
+        data['STRIPE_EXTRA_CUSTOMER_BALANCE_PER_EMAIL'] = 'a@a.com=five$'
+        form = CustomConstanceAdminForm(initial=initial, data=data)
+        data['version'] = form.initial['version']
+        self.assertFalse(form.is_valid())
+        self.assertIn('STRIPE_EXTRA_CUSTOMER_BALANCE_PER_EMAIL: Invalid "amount"', str(form.non_field_errors()))
+
     def test_assign_permission_to_group(self):
         group = Group.objects.create(name='Staff')
         self.assertFalse(self.user.has_perm('constance.change_config'))
@@ -0,0 +1,81 @@
+"""
+Parsers of the dynamic settings that are stored as strings but have a structure.
+The parsed values are cached per settings version, CustomConstanceAdminForm validates the input with the same parsers.
+"""
+from types import MappingProxyType
+
+from constance import config as dynamic_settings
+from django.core.exceptions import ValidationError
+
+from apps.dynamic_settings.utils import SettingsSnapshot
+from apps.general.validators import is_valid_email
+
+
+def _split(value):
+    return [x.strip() for x in (value or '').split(',') if x.strip()]
+
+
+def parse_int_list(value, strict=True):
+    """ "4,4,4" -> (4, 4, 4) """
+    result = []
+    for item in _split(value):
+        try:
+            result.append(int(item))
+        except ValueError:
+            if strict:
+                raise ValidationError('Invalid integer: %s' % item)
+    return tuple(result)
+
+
+def parse_email_list(value, strict=True):
+    """ "a@a.com, b@b.com" -> ('a@a.com', 'b@b.com') """
+    result = []
+    for email in _split(value):
+        if is_valid_email(email):
+            result.append(email)
+        elif strict:
+            raise ValidationError('Invalid email: %s' % email)
+    return tuple(result)
+
+
+def parse_email_amounts(value, strict=True):
+    """ "a@a.com=5$, b@b.com=15$" -> {'a@a.com': 5, 'b@b.com': 15} """
+    result = {}
+    for pair in _split(value):
+        try:
+            email, raw_amount = pair.split('=')
+        except ValueError:
+            if strict:
+                raise ValidationError('Invalid {email}={amount$} pair of values: %s' % pair)
+            continue
+        email = email.strip()
+        if not is_valid_email(email):
+            if strict:
+                raise ValidationError('Invalid "email": %s' % email)
+            continue
+        try:
+            result[email] = int(raw_amount.strip().replace('$', ''))
+        except ValueError:
+            if strict:
+                raise ValidationError('Invalid "amount": %s' % raw_amount)
+    return MappingProxyType(result)
+
+
+TYPED_SETTINGS = {
+    'DAYS_BETWEEN_ACTIVATION_EMAILS': parse_int_list,
+    'NO_PRICES_NOTIFICATION_RECIPIENTS': parse_email_list,
+    'STRIPE_EXTRA_CUSTOMER_BALANCE_PER_EMAIL': parse_email_amounts,
+}
+
+
+def _parse_typed_settings():
+    # values saved before the validation existed may be broken, invalid items are skipped then
+    return {key: parser(getattr(dynamic_settings, key), strict=False) for key, parser in TYPED_SETTINGS.items()}
+
+
+typed_settings_snapshot = SettingsSnapshot(_parse_typed_settings)
+
+
+def get_typed_setting(key):
+    """ Parsed value of a dynamic setting from TYPED_SETTINGS """
+    return typed_settings_snapshot.get()[key]
@@ -1,15 +1,42 @@
+import threading
+import time
+import uuid
 from collections import OrderedDict
 
 from django.conf import settings
 from django.contrib.auth.models import Permission, Group
+from django.core.cache import cache
 from constance.admin import get_values, Config
 
 from apps.dynamic_settings.constance_settings import CONSTANCE_CONFIG
-from apps.general.validators import is_valid_email
-from constance import config as dynamic_settings
+
+SETTINGS_VERSION_CACHE_KEY = 'dynamic_settings_version'
 
 
 class DynamicSettingsUtils:
+    # (monotonic time of the last read, version) of this process
+    _settings_version = (None, None)
+
+    @classmethod
+    def get_settings_version(cls):
+        """
+        Changes every time a constance value is saved.
+        The shared cache is read at most once per settings.DYNAMIC_SETTINGS_VERSION_CHECK_INTERVAL seconds.
+        """
+        read_at, version = cls._settings_version
+        now = time.monotonic()
+        if read_at is None or now - read_at >= getattr(settings, 'DYNAMIC_SETTINGS_VERSION_CHECK_INTERVAL', 2):
+            version = cache.get(SETTINGS_VERSION_CACHE_KEY)
+            cls._settings_version = (now, version)
+        return version
+
+    @classmethod
+    def bump_settings_version(cls, **kwargs):
+        """ Receiver of constance's config_updated signal """
+        version = uuid.uuid4().hex
+        cache.set(SETTINGS_VERSION_CACHE_KEY, version, None)
+        cls._settings_version = (time.monotonic(), version)
+
     @staticmethod
     def get_public_dynamic_settings():
         """ Returns constance keys that are public """
@@ -49,5 +76,35 @@ class DynamicSettingsUtils:
 
     @staticmethod
     def get_no_prices_notification_recipients():
-        emails = dynamic_settings.NO_PRICES_NOTIFICATION_RECIPIENTS or ''
-        return [x.strip() for x in emails.split(',') if is_valid_email(x.strip())]
+        from apps.dynamic_settings.typed_settings import get_typed_setting
+        return list(get_typed_setting('NO_PRICES_NOTIFICATION_RECIPIENTS'))
+
+
+class SettingsSnapshot:
+    """
+    Process-local value built from the dynamic settings, rebuilt only when the settings version changes.
+    The version key lives in the cache, so other processes pick the change up after
+    settings.DYNAMIC_SETTINGS_VERSION_CHECK_INTERVAL seconds, or DYNAMIC_SETTINGS_SNAPSHOT_TTL with a per-process cache.
+    """
+    def __init__(self, build):
+        self.build = build
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        version = DynamicSettingsUtils.get_settings_version()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] != version or self._expired(snapshot):
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot[0] != version or self._expired(snapshot):
+                    # version is read before building, so a change made meanwhile triggers another rebuild
+                    snapshot = self._snapshot = (version, time.monotonic(), self.build())
+        return snapshot[2]
+
+    def clear(self):
+        self._snapshot = None
+
+    @staticmethod
+    def _expired(snapshot):
+        return time.monotonic() - snapshot[1] >= getattr(settings, 'DYNAMIC_SETTINGS_SNAPSHOT_TTL', 60)
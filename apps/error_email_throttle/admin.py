@@ -6,11 +6,11 @@ from .models import ErrorReport
 class ErrorReportAdmin(admin.ModelAdmin):
     list_display = [
         'filename', 'function', 'lineno', 'latest_error',
-        'last_emailed', 'error_count', 'affected_urls'
+        'last_emailed', 'error_count', 'affected_url_count'
     ]
     readonly_fields = [
         'filename', 'function', 'lineno', 'context_line', 'error_count',
-        'urls', 'error_hash', 'last_emailed', 'error_date', 'latest_error',
+        'affected_url_count', 'urls', 'error_hash', 'last_emailed', 'error_date', 'latest_error',
         'stack_trace'
     ]
     list_order = ['-latest_error']
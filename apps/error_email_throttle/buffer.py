@@ -0,0 +1,137 @@
+"""
+In-process aggregation of error occurrences. The failing request only updates a dict,
+the occurrences are written to ErrorReport with F() updates once per settings.ERROR_REPORT_FLUSH_INTERVAL seconds.
+Only claiming an email slot touches the DB at once, as the throttling must hold across the processes.
+"""
+import atexit
+import json
+import threading
+from collections import Counter
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F, Q
+from django.utils import timezone
+
+# distinct urls kept per error between two flushes
+MAX_BUFFERED_URLS = 100
+# errors whose email throttling is remembered per process
+MAX_THROTTLED_ERRORS = 1000
+
+
+class ErrorReportBuffer:
+    def __init__(self):
+        self._pending = {}
+        self._known_hashes = set()  # errors already stored by this process
+        self._throttled_until = {}  # error hash -> time until which an email of it was claimed, by any process
+        self._lock = threading.Lock()
+        self._flush_timer = None
+
+    def claim_email_slot(self, error_hash, frame):
+        """
+        True at most once per settings.ERROR_EMAIL_THROTTLING_TIME per error across all the processes:
+        the slot is claimed by a conditional update of ErrorReport.last_emailed (or by creating the report).
+        A process that lost the claim remembers until when, so it doesn't ask the DB again meanwhile.
+        """
+        ErrorReport = apps.get_model('error_email_throttle', 'ErrorReport')
+        now = timezone.now()
+        if self._throttled_until.get(error_hash, now) > now:
+            return False
+        throttling_time = timedelta(seconds=getattr(settings, 'ERROR_EMAIL_THROTTLING_TIME', 30))
+        claimed = ErrorReport.objects.filter(error_hash=error_hash).filter(
+            Q(last_emailed__isnull=True) | Q(last_emailed__lte=now - throttling_time)).update(last_emailed=now)
+        if not claimed:
+            try:
+                with transaction.atomic():
+                    # counts and urls are added by the next flush
+                    ErrorReport.objects.create(error_hash=error_hash, error_date=now.date(), latest_error=now,
+                                               last_emailed=now, urls='{}', **frame)
+                claimed = True
+            except IntegrityError:  # the report exists and was emailed recently
+                last_emailed = ErrorReport.objects.filter(error_hash=error_hash).values_list(
+                    'last_emailed', flat=True).first()
+                self._remember_throttled(error_hash, (last_emailed or now) + throttling_time, now)
+        if claimed:
+            self._remember_throttled(error_hash, now + throttling_time, now)
+        return bool(claimed)
+
+    def _remember_throttled(self, error_hash, until, now):
+        if len(self._throttled_until) >= MAX_THROTTLED_ERRORS:
+            self._throttled_until = {k: v for k, v in self._throttled_until.items() if v > now}
+        self._throttled_until[error_hash] = until
+
+    def is_known(self, error_hash):
+        """ Whether the stack trace of the error is already stored or buffered, so that it needn't be rendered """
+        return error_hash in self._known_hashes or error_hash in self._pending
+
+    def add(self, error_hash, frame, url, stack_trace=None):
+        now = timezone.now()
+        interval = getattr(settings, 'ERROR_REPORT_FLUSH_INTERVAL', 10)
+        with self._lock:
+            occurrences = self._pending.get(error_hash)
+            if occurrences is None:
+                occurrences = self._pending[error_hash] = {
+                    'frame': frame, 'count': 0, 'first': now, 'urls': Counter(), 'stack_trace': stack_trace,
+                }
+            occurrences['count'] += 1
+            occurrences['latest'] = now
+            if url in occurrences['urls'] or len(occurrences['urls']) < MAX_BUFFERED_URLS:
+                occurrences['urls'][url] += 1
+            if interval and self._flush_timer is None:
+                self._flush_timer = threading.Timer(interval, self._flush_in_thread)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if not interval:
+            self.flush()
+
+    def _flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        for error_hash, occurrences in pending.items():
+            try:
+                self._store(error_hash, occurrences)
+            except Exception:
+                pass  # logging here would feed the error handler again
+            self._known_hashes.add(error_hash)
+
+    @staticmethod
+    def _store(error_hash, occurrences):
+        ErrorReport = apps.get_model('error_email_throttle', 'ErrorReport')
+        updates = {'error_count': F('error_count') + occurrences['count'], 'latest_error': occurrences['latest']}
+        if not ErrorReport.objects.filter(error_hash=error_hash).update(**updates):
+            try:
+                with transaction.atomic():
+                    ErrorReport.objects.create(
+                        error_hash=error_hash,
+                        error_date=occurrences['first'].date(),
+                        latest_error=occurrences['latest'],
+                        error_count=occurrences['count'],
+                        stack_trace=occurrences['stack_trace'] or '',
+                        urls=json.dumps(dict(occurrences['urls'].most_common(
+                            getattr(settings, 'ERROR_REPORT_MAX_URLS', 50)))),
+                        affected_url_count=len(occurrences['urls']),
+                        **occurrences['frame']
+                    )
+                return
+            except IntegrityError:  # another process created it meanwhile
+                ErrorReport.objects.filter(error_hash=error_hash).update(**updates)
+        if occurrences['stack_trace']:  # the report may have been created by `claim_email_slot`
+            ErrorReport.objects.filter(error_hash=error_hash, stack_trace='').update(
+                stack_trace=occurrences['stack_trace'])
+        ErrorReport.objects.only('urls', 'affected_url_count').get(error_hash=error_hash).add_urls(
+            occurrences['urls'])
+
+
+error_report_buffer = ErrorReportBuffer()
+atexit.register(error_report_buffer.flush)
@@ -0,0 +1,82 @@
+"""
+Digest mode of the error emails: occurrences are aggregated per error over settings.ERROR_EMAIL_DIGEST_WINDOW seconds
+and the admins get one summary email per window instead of one email per error.
+"""
+import threading
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.db import connection
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from apps.error_email_throttle.utils import normalize_url
+
+TOP_URLS = 5
+MAX_URLS = 100  # distinct urls counted per error and window
+
+
+class ErrorDigest:
+    def __init__(self):
+        self._errors = OrderedDict()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, frame, subject, url, render_traceback):
+        """
+        :param render_traceback: renders the representative traceback, called for the first occurrence only
+        """
+        key = (frame['filename'], frame['lineno'], frame['function'], frame['context_line'])
+        now = timezone.now()
+        with self._lock:
+            error = self._errors.get(key)
+            if error is None:
+                error = self._errors[key] = {
+                    'subject': subject, 'frame': frame, 'count': 0, 'first_seen': now, 'urls': Counter(),
+                    'render_traceback': render_traceback,
+                }
+            error['count'] += 1
+            error['last_seen'] = now
+            url = normalize_url(url)
+            if url in error['urls'] or len(error['urls']) < MAX_URLS:
+                error['urls'][url] += 1
+            if self._timer is None:
+                self._timer = threading.Timer(settings.ERROR_EMAIL_DIGEST_WINDOW, self._send_in_thread)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _send_in_thread(self):
+        try:
+            self.send()
+        except Exception:
+            pass  # logging here would feed the error handler again
+        finally:
+            connection.close()
+
+    def send(self):
+        """ Emails the summary of the errors collected since the last one """
+        from apps.general.services import Emailer
+
+        with self._lock:
+            errors, self._errors = list(self._errors.values()), OrderedDict()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not errors or not settings.ADMINS:
+            return 0
+
+        for error in errors:
+            error['top_urls'] = error['urls'].most_common(TOP_URLS)
+            try:
+                error['traceback'] = error['render_traceback']()
+            except Exception:
+                error['traceback'] = None
+        errors.sort(key=lambda error: error['count'], reverse=True)
+        subject = '%s%s errors, %s occurrences in the last %s seconds' % (
+            settings.EMAIL_SUBJECT_PREFIX, len(errors), sum(error['count'] for error in errors),
+            settings.ERROR_EMAIL_DIGEST_WINDOW)
+        html_body = render_to_string('error_email_throttle/digest.html', {'errors': errors})
+        return Emailer().send_mass_email([(subject, html_body, email) for _, email in settings.ADMINS])
+
+
+error_digest = ErrorDigest()
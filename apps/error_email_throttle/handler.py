@@ -1,10 +1,66 @@
+import linecache
 import logging
+import queue
+import threading
 from django.apps import apps
 from copy import copy
 from django.conf import settings
+from django.db import connection
 from django.views.debug import ExceptionReporter
 from django.utils.log import AdminEmailHandler
 
+from apps.error_email_throttle.digest import error_digest
+
+
+def get_lastframe(exc_info):
+    """ The frame ExceptionReporter would report as the last one, without rendering anything """
+    tb = exc_info[2] if exc_info else None
+    lastframe = None
+    while tb is not None:
+        if not tb.tb_frame.f_locals.get('__traceback_hide__'):
+            lastframe = tb
+        tb = tb.tb_next
+    if lastframe is None:
+        return None
+    filename = lastframe.tb_frame.f_code.co_filename
+    return {
+        'filename': filename,
+        'lineno': lastframe.tb_lineno,
+        'function': lastframe.tb_frame.f_code.co_name,
+        'context_line': linecache.getline(filename, lastframe.tb_lineno).rstrip('\r\n') or
+        '<source code not available>',
+    }
+
+
+class _ReportQueue:
+    """ Bounded queue of reports rendered and emailed by one background thread; reports over the limit are dropped """
+    def __init__(self):
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def put(self, job):
+        with self._lock:
+            if self._queue is None:
+                self._queue = queue.Queue(maxsize=getattr(settings, 'ERROR_EMAIL_QUEUE_SIZE', 100))
+                threading.Thread(target=self._work, name='error-email-sender', daemon=True).start()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            pass
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job()
+            except Exception:
+                pass  # logging here would feed the error handler again
+            finally:
+                connection.close()
+
+
+report_queue = _ReportQueue()
+
 
 class AdminEmailThrottler(AdminEmailHandler):
     def __init__(self, include_html=False, email_backend=None):
@@ -29,31 +85,61 @@ class AdminEmailThrottler(AdminEmailHandler):
             request = None
         subject = self.format_subject(subject)
 
+        if record.exc_info:
+            exc_info = record.exc_info
+        else:
+            exc_info = (None, record.getMessage(), None)
+
+        if getattr(settings, 'ERROR_EMAIL_DIGEST_WINDOW', None):
+            self._add_to_digest(subject, request, exc_info)
+            return
+
+        if not self._can_send_email(request, exc_info):
+            return
+
         # Since we add a nicely formatted traceback on our own, create a copy
         # of the log record without the exception data.
         no_exc_record = copy(record)
         no_exc_record.exc_info = None
         no_exc_record.exc_text = None
 
-        if record.exc_info:
-            exc_info = record.exc_info
+        if getattr(settings, 'ERROR_EMAIL_ASYNC', True):
+            report_queue.put(lambda: self._send_report(subject, no_exc_record, request, exc_info))
         else:
-            exc_info = (None, record.getMessage(), None)
+            self._send_report(subject, no_exc_record, request, exc_info)
 
+    def _send_report(self, subject, no_exc_record, request, exc_info):
         reporter = ExceptionReporter(request, is_email=True, *exc_info)
         message = "%s\n\n%s" % (
             self.format(no_exc_record), reporter.get_traceback_text()
         )
         html_message = reporter.get_traceback_html() if self.include_html else None
-        if self._can_send_email(reporter, record):
-            self.send_mail(
-                subject, message, fail_silently=True, html_message=html_message
-            )
+        self.send_mail(
+            subject, message, fail_silently=True, html_message=html_message
+        )
+
+    def _add_to_digest(self, subject, request, exc_info):
+        frame = get_lastframe(exc_info)
+        if frame is None:
+            return
+        self._record_occurrence(request, exc_info, claim_email=False)  # the digest replaces the email itself
+        error_digest.add(frame, subject, request.get_full_path() if request is not None else '',
+                         lambda: ExceptionReporter(request, is_email=True, *exc_info).get_traceback_text())
+
+    def _can_send_email(self, request, exc_info):
+        return self._record_occurrence(request, exc_info)
 
-    def _can_send_email(self, reporter, record):
+    def _record_occurrence(self, request, exc_info, claim_email=True):
+        """ Keeps the ErrorReport stats; tells whether to email, which claims the throttling slot then """
         ErrorReport = apps.get_model('error_email_throttle', 'ErrorReport')
         # Disallowed host email etc may not have a stack trace to analyse.
+        frame = get_lastframe(exc_info)
+        if frame is None:
+            return False
         try:
-            return ErrorReport.objects.add_error_log(reporter, record)
+            url = request.get_full_path() if request is not None else ''
+            return ErrorReport.objects.add_occurrence(
+                frame, url, lambda: ExceptionReporter(request, is_email=True, *exc_info).get_traceback_text(),
+                claim_email=claim_email)
         except Exception:
-            return True
+            return claim_email
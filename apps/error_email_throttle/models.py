@@ -2,13 +2,21 @@ from __future__ import unicode_literals
 
 import json
 import hashlib
+
+from django.conf import settings
 from django.db import models
+from django.db.models import F
 from django.utils import timezone
-from django.conf import settings
 
+from apps.error_email_throttle.buffer import error_report_buffer
+from apps.error_email_throttle.utils import normalize_url
 from apps.general.models import BaseCreatedModifiedModel
 
 
+# conditional updates tried by `ErrorReport.add_urls` when other processes merge urls at the same time
+URL_MERGE_ATTEMPTS = 3
+
+
 def _get_error_hash(filename, lineno, function, context_line):
     key = filename + str(lineno) + function + context_line
     return hashlib.sha256(key.encode('utf8')).hexdigest()
@@ -20,43 +28,27 @@ class ErrorReportManager(models.Manager):
         if not lastframe:
             return
         url = record.request.get_full_path() if hasattr(record, 'request') else ''
-        filename = lastframe.get('filename')
-        lineno = lastframe.get('lineno')
-        context_line = lastframe.get('context_line')
-        function = lastframe.get('function')
-
-        error_hash = _get_error_hash(filename, lineno, function, context_line)
-        error_report = ErrorReport.objects.filter(
-            error_hash=error_hash
-        ).first()
-
-        if error_report:
-            time_diff = (timezone.now() - error_report.last_emailed)
-            send_email = False
-            time_diff_allowed = getattr(
-                settings, 'ERROR_EMAIL_THROTTLING_TIME', 30)
-            if time_diff.total_seconds() > time_diff_allowed:
-                send_email = True
-
-            error_report.update_stats(url=url, send_email=send_email)
-            return send_email
-
-        urls = json.dumps([url])
-        ErrorReport.objects.create(
-            error_date=timezone.now().date(),
-            latest_error=timezone.now(),
-            error_count=1,
-            function=function,
-            filename=filename,
-            lineno=lineno,
-            error_hash=error_hash,
-            context_line=context_line,
-            urls=urls,
-            stack_trace=reporter.get_traceback_text(),
-            last_emailed=timezone.now()
-        )
-
-        return True
+        frame = {
+            'filename': lastframe.get('filename'),
+            'lineno': lastframe.get('lineno'),
+            'function': lastframe.get('function'),
+            'context_line': lastframe.get('context_line'),
+        }
+        return self.add_occurrence(frame, url, reporter.get_traceback_text)
+
+    def add_occurrence(self, frame, url, get_stack_trace, claim_email=True):
+        """
+        Records an occurrence of the error and tells whether it should be emailed.
+        Occurrences are aggregated in-process and written by `error_report_buffer`, only the email throttling
+        asks the DB, at most once per error and process while the error is throttled.
+        :param get_stack_trace: renders the stack trace, called only for errors this process hasn't stored yet
+        :param claim_email: False when no email is sent for the occurrence (digest mode), so `last_emailed` is kept
+        """
+        error_hash = _get_error_hash(**frame)
+        send_email = claim_email and error_report_buffer.claim_email_slot(error_hash, frame)
+        stack_trace = None if error_report_buffer.is_known(error_hash) else get_stack_trace()
+        error_report_buffer.add(error_hash, frame, normalize_url(url), stack_trace=stack_trace)
+        return send_email
 
 
 class ErrorReport(BaseCreatedModifiedModel, models.Model):
@@ -72,7 +64,10 @@ class ErrorReport(BaseCreatedModifiedModel, models.Model):
     context_line = models.TextField(null=True, blank=True)
     error_hash = models.CharField(max_length=200, unique=True)
 
+    # JSON of {normalized url: occurrences} for the settings.ERROR_REPORT_MAX_URLS most frequent urls
     urls = models.TextField()
+    # distinct normalized urls seen; approximate once more than ERROR_REPORT_MAX_URLS of them were seen
+    affected_url_count = models.IntegerField(default=0)
 
     objects = ErrorReportManager()
 
@@ -81,24 +76,37 @@ class ErrorReport(BaseCreatedModifiedModel, models.Model):
             self.filename, self.lineno, self.error_count
         )
 
-    def update_stats(self, url, send_email):
-        urls = []
-        if self.urls:
-            urls = json.loads(self.urls)
-
-        urls.append(url)
-        urls = list(set(urls))
-
-        if send_email:
-            self.last_emailed = timezone.now()
-
-        self.urls = json.dumps(urls)
-        self.error_count += 1
-        self.latest_error = timezone.now()
-        self.save()
+    def get_url_counts(self):
+        urls = json.loads(self.urls) if self.urls else {}
+        if isinstance(urls, list):  # stored before the occurrences were counted
+            urls = {url: 1 for url in urls}
+        return urls
+
+    def add_urls(self, url_counts):
+        """
+        Merges {url: occurrences} into the stored ones, keeping the most frequent urls only.
+        The update is conditional on the urls it was computed from, so a concurrent merge of another process
+        is re-read and merged again instead of being overwritten.
+        """
+        for _ in range(URL_MERGE_ATTEMPTS):
+            urls = self.get_url_counts()
+            added_count = len(set(url_counts) - set(urls))
+            for url, count in url_counts.items():
+                urls[url] = urls.get(url, 0) + count
+            merged = json.dumps(dict(_most_common(urls)))
+            if ErrorReport.objects.filter(pk=self.pk, urls=self.urls).update(
+                    urls=merged, affected_url_count=F('affected_url_count') + added_count):
+                self.urls = merged
+                self.affected_url_count += added_count
+                return True
+            self.refresh_from_db(fields=['urls', 'affected_url_count'])
+        return False
 
     @property
     def affected_urls(self):
-        if self.urls:
-            return len(json.loads(self.urls))
-        return 0
+        return self.affected_url_count
+
+
+def _most_common(url_counts):
+    return sorted(url_counts.items(), key=lambda item: item[1], reverse=True)[
+        :getattr(settings, 'ERROR_REPORT_MAX_URLS', 50)]
@@ -1,6 +1,17 @@
-from django.test import TestCase, RequestFactory
+import logging
+import sys
+from datetime import timedelta
+from unittest.mock import patch
 
-from apps.error_email_throttle.models import ErrorReport
+from django.core import mail
+from django.core.cache import cache
+from django.test import TestCase, RequestFactory, override_settings
+from django.utils import timezone
+
+from apps.error_email_throttle.buffer import ErrorReportBuffer
+from apps.error_email_throttle.digest import error_digest
+from apps.error_email_throttle.handler import AdminEmailThrottler, get_lastframe
+from apps.error_email_throttle.models import ErrorReport, normalize_url
 
 request_factory = RequestFactory()
 
@@ -25,7 +36,108 @@ class MockRecord(object):
 
 
 class TestErrorReportManager(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.buffer = ErrorReportBuffer()
+        patcher = patch('apps.error_email_throttle.models.error_report_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_add_error_log(self):
         reporter = MockReporter()
         record = MockRecord()
         ErrorReport.objects.add_error_log(reporter, record)
+
+    def test_aggregates_occurrences_and_throttles_emails(self):
+        reporter = MockReporter()
+        with override_settings(ERROR_REPORT_FLUSH_INTERVAL=60):
+            self.assertTrue(ErrorReport.objects.add_error_log(reporter, MockRecord()))
+            self.assertFalse(ErrorReport.objects.add_error_log(reporter, MockRecord()))
+            self.assertEqual(ErrorReport.objects.get().error_count, 0)  # created by the email claim only
+            self.buffer.flush()
+
+        error_report = ErrorReport.objects.get()
+        self.assertEqual(error_report.error_count, 2)
+        self.assertEqual(error_report.stack_trace, 'foobar')
+        self.assertEqual(error_report.affected_url_count, 1)
+
+    def test_email_throttling_holds_across_processes(self):
+        frame = MockReporter().get_traceback_data()['lastframe']
+        self.assertTrue(ErrorReportBuffer().claim_email_slot('hash', frame))
+        self.assertFalse(ErrorReportBuffer().claim_email_slot('hash', frame))  # another process
+        ErrorReport.objects.update(last_emailed=timezone.now() - timedelta(minutes=5))
+        self.assertTrue(ErrorReportBuffer().claim_email_slot('hash', frame))
+
+    def test_concurrent_url_merges_are_not_lost(self):
+        ErrorReport.objects.add_error_log(MockReporter(), MockRecord())
+        report, stale_report = ErrorReport.objects.get(), ErrorReport.objects.get()
+        report.add_urls({'/a/': 1})
+        stale_report.add_urls({'/b/': 2})
+
+        report.refresh_from_db()
+        self.assertEqual(report.get_url_counts(), {'/': 1, '/a/': 1, '/b/': 2})
+        self.assertEqual(report.affected_url_count, 3)
+
+    @override_settings(ERROR_REPORT_MAX_URLS=2)
+    def test_keeps_most_frequent_normalized_urls(self):
+        reporter = MockReporter()
+        for url in ('/residents/1/?tab=1', '/residents/2/', '/a/', '/b/'):
+            record = MockRecord()
+            record.request = request_factory.get(url)
+            ErrorReport.objects.add_error_log(reporter, record)
+
+        error_report = ErrorReport.objects.get()
+        self.assertEqual(error_report.affected_url_count, 3)
+        self.assertEqual(len(error_report.get_url_counts()), 2)
+        self.assertEqual(error_report.get_url_counts()['/residents/:id/'], 2)
+
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url('/residents/42/edit/?tab=1'), '/residents/:id/edit/')
+        self.assertEqual(normalize_url('/tasks/0b5e1a3c-9f1d-4c4e-8f3a-2f6d7a1b9c0d/'), '/tasks/:id/')
+
+
+@override_settings(ADMINS=[('Admin', 'admin@email.com')])
+class TestAdminEmailThrottler(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = patch('apps.error_email_throttle.models.error_report_buffer', ErrorReportBuffer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _emit(self):
+        try:
+            raise ValueError('foo')
+        except ValueError:
+            record = logging.LogRecord(
+                'django', logging.ERROR, __file__, 1, 'Internal Server Error', (), sys.exc_info())
+        record.request = request_factory.get('/residents/1/')
+        AdminEmailThrottler().emit(record)
+
+    def test_throttled_errors_are_not_rendered(self):
+        self._emit()
+        with patch('apps.error_email_throttle.handler.ExceptionReporter') as mock_reporter:
+            self._emit()
+        mock_reporter.assert_not_called()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(ErrorReport.objects.get().error_count, 2)
+
+    @override_settings(ERROR_EMAIL_DIGEST_WINDOW=60)
+    def test_digest_mode_sends_one_summary(self):
+        self._emit()
+        self._emit()
+        self.assertEqual(len(mail.outbox), 0)
+        error_digest.send()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('1 errors, 2 occurrences', mail.outbox[0].subject)
+        self.assertIn('/residents/:id/', mail.outbox[0].body)
+        error_report = ErrorReport.objects.get()
+        self.assertEqual(error_report.error_count, 2)
+        self.assertIsNone(error_report.last_emailed)
+
+    def test_get_lastframe(self):
+        try:
+            raise ValueError('foo')
+        except ValueError:
+            frame = get_lastframe(sys.exc_info())
+        self.assertEqual(frame['function'], 'test_get_lastframe')
+        self.assertEqual(frame['context_line'].strip(), "raise ValueError('foo')")
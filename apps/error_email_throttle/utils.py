@@ -0,0 +1,10 @@
+import re
+
+# path segments that are ids: numbers, uuids, long hex strings
+_ID_SEGMENT_RE = re.compile(r'^(\d+|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{16,})$', re.I)
+
+
+def normalize_url(url):
+    """ /residents/42/edit/?tab=1 -> /residents/:id/edit/ """
+    path = url.split('?', 1)[0]
+    return '/'.join(':id' if _ID_SEGMENT_RE.match(segment) else segment for segment in path.split('/'))
@@ -1,4 +1,7 @@
+from django.contrib import admin
+
 from apps.appointments.forms import ImportForm
+from apps.general.models import OutboundNotification
 
 
 class ReadOnlyAfterCreatedMixin:
@@ -39,3 +42,14 @@ class MatchingRulesMixin:
                    'rules_title': self.matching_rules_title}
         context.update(extra_context or {})
         return context
+
+
+class OutboundNotificationAdmin(ShowCreatedModifiedMixin, admin.ModelAdmin):
+    list_display = ['id', 'channel', 'method', 'status', 'attempts', 'next_attempt_at', 'sent_at', 'created_at']
+    list_filter = ['channel', 'status']
+    search_fields = ['idempotency_key']
+    readonly_fields = ['channel', 'method', 'payload', 'idempotency_key', 'attempts', 'sent_at', 'last_error']
+    ordering = ['-id']
+
+
+admin.site.register(OutboundNotification, OutboundNotificationAdmin)
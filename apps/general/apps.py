@@ -7,3 +7,5 @@ class GeneralConfig(AppConfig):
     # noinspection PyUnresolvedReferences
     def ready(self):
         import apps.general.celery
+        from apps.general.graphql import connect_response_cache_signals
+        connect_response_cache_signals()
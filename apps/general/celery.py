@@ -1,72 +1,219 @@
 import json
-import subprocess
-import importlib
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import timedelta
 
+from celery import current_app
+from celery.signals import (
+    heartbeat_sent, worker_ready, worker_shutdown, worker_process_shutdown, before_task_publish, task_prerun,
+    task_postrun, task_retry,
+)
+from constance import config as dynamic_settings
+from django.conf import settings
+from django.contrib import admin
 from django.conf.urls import url
 from django.core.cache import cache
-from django.shortcuts import redirect
+from django.db import connection, transaction, IntegrityError
+from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils.html import format_html
 from django_celery_beat.admin import PeriodicTaskAdmin
 from django_celery_beat.models import PeriodicTask
 from django_celery_results.admin import TaskResultAdmin
 from django_celery_results.backends import DatabaseBackend
+from django_celery_results.models import TaskResult
 
 from apps.general.decorators import run_on_commit
-from apps.general.loggers import django_logger
-from apps.general.utils import in_tests
+from apps.general.loggers import django_logger, logstash_logger
+from apps.general.metrics import metrics, get_published_metrics
+from apps.general.models import TaskResultName
+from apps.general.utils import in_tests, DateUtils
+
+WORKER_HEARTBEAT_CACHE_KEY = 'celery_worker_heartbeat'
+WORKERS_AVAILABLE_CACHE_KEY = 'celery_workers_available'
+TASK_METRICS_PREFIX = 'celery.task.'
+
+
+# backends holding buffered results, flushed on worker shutdown
+_buffering_backends = weakref.WeakSet()
 
 
 class WMCPDatabaseBackend(DatabaseBackend):
+    """
+    Custom result backend that also stores a task name (into TaskResultName) and prunes expired results in chunks.
+    Results of tasks listed in settings.CELERY_IGNORE_RESULT_TASKS are not stored at all.
+    With settings.CELERY_RESULT_BUFFER_SIZE results are buffered in the worker and stored in bulk once the buffer
+    is full, settings.CELERY_RESULT_BUFFER_FLUSH_INTERVAL seconds passed, or the worker shuts down,
+    so they are not visible to result.get() until then.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._buffer = OrderedDict()
+        self._buffer_lock = threading.Lock()
+        self._flush_timer = None
+
     def mark_as_failure(self, task_id, exc, *args, **kwargs):
         """Mark task as executed with failure."""
         django_logger.exception('Celery task failed: %s' % exc, exc_info=exc)
         super().mark_as_failure(task_id, exc, *args, **kwargs)
 
-    """Custom result backend that also stores a task name."""
     def _store_result(self, task_id, result, status,
                       traceback=None, request=None):
         """Store return value and status of an executed task."""
+        task_name = getattr(request, 'task', None)
+        if task_name in getattr(settings, 'CELERY_IGNORE_RESULT_TASKS', ()):
+            return result
+
         content_type, content_encoding, result = self.encode_content(result)
         _, _, meta = self.encode_content({
             'children': self.current_task_children(request),
-            'task_name': request.task
+            'task_name': task_name
         })
+        fields = {
+            'content_type': content_type,
+            'content_encoding': content_encoding,
+            'result': result,
+            'status': status,
+            'traceback': traceback,
+            'meta': meta,
+        }
 
-        self.TaskModel._default_manager.store_result(
-            content_type, content_encoding,
-            task_id, result, status,
-            traceback=traceback,
-            meta=meta,
-        )
+        if getattr(settings, 'CELERY_RESULT_BUFFER_SIZE', 0):
+            self._buffer_result(task_id, task_name, fields)
+        else:
+            self._store_one(task_id, task_name, fields)
         return result
 
+    def _store_one(self, task_id, task_name, fields):
+        """
+        A new result is inserted together with its name in one transaction, without the SELECTs of get_or_create;
+        a result stored already (e.g. of a retried task) is updated with one query, its name is kept.
+        """
+        manager = self.TaskModel._default_manager
+        try:
+            with transaction.atomic():
+                obj = manager.create(task_id=task_id, **fields)
+                if task_name:
+                    TaskResultName.objects.create(task_result=obj, task_name=task_name)
+        except IntegrityError:
+            manager.filter(task_id=task_id).update(date_done=DateUtils.utc_now(), **fields)
+
+    def _buffer_result(self, task_id, task_name, fields):
+        with self._buffer_lock:
+            self._buffer[task_id] = (task_name, fields)  # the latest status of a task wins
+            is_full = len(self._buffer) >= settings.CELERY_RESULT_BUFFER_SIZE
+            if not is_full and self._flush_timer is None:
+                self._flush_timer = threading.Timer(
+                    getattr(settings, 'CELERY_RESULT_BUFFER_FLUSH_INTERVAL', 5), self._flush_in_thread)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        _buffering_backends.add(self)
+        if is_full:
+            self.flush()
+
+    def _flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+    def flush(self):
+        """Store buffered results: two queries for the new ones plus one per already stored (e.g. retried) task."""
+        with self._buffer_lock:
+            pending, self._buffer = self._buffer, OrderedDict()
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        if not pending:
+            return
+
+        manager = self.TaskModel._default_manager
+        try:
+            with transaction.atomic():
+                existing = set(manager.filter(task_id__in=list(pending)).values_list('task_id', flat=True))
+                created = manager.bulk_create([self.TaskModel(task_id=task_id, **fields)
+                                               for task_id, (_, fields) in pending.items() if task_id not in existing])
+                TaskResultName.objects.bulk_create([TaskResultName(task_result=obj, task_name=pending[obj.task_id][0])
+                                                    for obj in created if pending[obj.task_id][0]])
+                for task_id in existing:
+                    manager.filter(task_id=task_id).update(date_done=DateUtils.utc_now(), **pending[task_id][1])
+        except IntegrityError:  # another worker stored some of them meanwhile
+            for task_id, (task_name, fields) in pending.items():
+                self._store_one(task_id, task_name, fields)
+        except Exception:
+            django_logger.exception('Storing %s celery task results failed' % len(pending))
+
+    def cleanup(self):
+        """Run daily by celery beat's built-in `celery.backend_cleanup` task"""
+        prune_task_results()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_task_results(**kwargs):
+    for backend in list(_buffering_backends):
+        backend.flush()
+
+
+def prune_task_results(chunk_size=None):
+    """
+    Deletes results older than the CELERY_TASK_RESULT_EXPIRES dynamic setting.
+    Walks the primary key index in chunks, each deleted in its own short transaction, so that the table isn't locked
+    for long. Returns the number of deleted results.
+    """
+    chunk_size = chunk_size or getattr(settings, 'CELERY_RESULT_PRUNE_CHUNK_SIZE', 1000)
+    expired = TaskResult.objects.filter(
+        date_done__lt=DateUtils.utc_now() - timedelta(seconds=dynamic_settings.CELERY_TASK_RESULT_EXPIRES))
+    deleted, last_pk = 0, 0
+    while True:
+        pks = list(expired.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            return deleted
+        TaskResult.objects.filter(pk__in=pks).delete()
+        deleted += len(pks)
+        last_pk = pks[-1]
+
+
+def task_result_name(self, obj):
+    try:
+        return obj.task_name_info.task_name
+    except TaskResultName.DoesNotExist:  # stored before the names had their own table
+        return json.loads(obj.meta or '{}').get('task_name')
+
+
 # Monkey-patching for displaying also the 'task_name' in the admin task results table.
 # A more clean approach with unregister\register leads to errors.
 TaskResultAdmin.list_display = ('task_id', 'date_done', 'status', 'task_name')
-TaskResultAdmin.task_name = lambda self, obj: json.loads(obj.meta)['task_name']
+TaskResultAdmin.list_filter = ('status', 'task_name_info__task_name')
+TaskResultAdmin.list_select_related = ('task_name_info',)
+TaskResultAdmin.task_name = task_result_name
 TaskResultAdmin.task_name.short_description = 'Task name'
 
 
+_task_registry = None
+
+
+def get_task_registry():
+    """ Celery tasks by name, built once per process so that the admin never imports task modules per row """
+    global _task_registry
+    if _task_registry is None:
+        current_app.loader.import_default_modules()
+        _task_registry = dict(current_app.tasks)
+    return _task_registry
+
+
 def import_task(task_id):
     try:
-        task_path = PeriodicTask.objects.get(id=task_id).task
-        module_path, task_name = task_path.rsplit('.', 1)
-        module = importlib.import_module(module_path)
-        task = getattr(module, task_name)
+        task = get_task_registry()[PeriodicTask.objects.get(id=task_id).task]
         return task, True
-    except Exception:
+    except (PeriodicTask.DoesNotExist, KeyError):
         return None, False
 
 
 def task_actions(self, obj):
-    key = 'task_%s_importable' % obj.pk
-    is_importable = cache.get(key)
-    if is_importable is None:
-        _, is_importable = import_task(obj.pk)
-        cache.set(key, is_importable, 60 * 60)
-
-    if is_importable:
+    if obj.task in get_task_registry():
         return format_html('<a class="button" href="%s">Run</a>' % reverse('admin:run_task', args=[obj.pk]))
     else:
         return ''
@@ -88,17 +235,158 @@ PeriodicTaskAdmin.list_display = PeriodicTaskAdmin.list_display + ('task_actions
 PeriodicTaskAdmin.get_urls = task_get_urls
 
 
-def run_task(task, *args, **kwargs):
+_heartbeat_stored_at = 0
+# until when this process takes the workers for available without asking the cache
+_workers_available_until = 0
+
+
+@worker_ready.connect
+@heartbeat_sent.connect
+def store_worker_heartbeat(**kwargs):
+    """ Workers refresh the key in the shared cache a few times per settings.CELERY_WORKER_AVAILABILITY_TTL """
+    global _heartbeat_stored_at
+    ttl = getattr(settings, 'CELERY_WORKER_AVAILABILITY_TTL', 30)
+    if time.monotonic() - _heartbeat_stored_at < ttl / 3:
+        return
+    _heartbeat_stored_at = time.monotonic()
+    cache.set(WORKER_HEARTBEAT_CACHE_KEY, time.time(), ttl)
+
+
+@worker_shutdown.connect
+def clear_worker_heartbeat(**kwargs):
+    global _heartbeat_stored_at, _workers_available_until
+    _heartbeat_stored_at = _workers_available_until = 0
+    cache.delete_many([WORKER_HEARTBEAT_CACHE_KEY, WORKERS_AVAILABLE_CACHE_KEY])
+
+
+def workers_available():
     """
-    Runs celery task asynchronously if celery workers are available, else synchronously.
-    This works only until we have workers and rabbitmq on the same instance as our app,
-    rather than on remote nodes.
+    Whether any celery worker is up, either on this instance or on remote nodes.
+    A fresh worker heartbeat in the shared cache (settings.CACHES) is enough. Otherwise the workers are pinged,
+    waiting for the first reply only, and the answer is cached for settings.CELERY_WORKER_AVAILABILITY_TTL seconds.
+    A positive answer is also kept in the process for settings.CELERY_WORKER_AVAILABILITY_MEMO seconds.
     """
-    ps = subprocess.Popen(['ps', 'aux'], stdout=subprocess.PIPE)
-    grep1 = subprocess.Popen(['grep', '-v', 'grep'], stdin=ps.stdout, stdout=subprocess.PIPE)
-    grep2 = subprocess.Popen(['grep', 'celery.*worker'], stdin=grep1.stdout, stdout=subprocess.PIPE)
+    global _workers_available_until
+    if time.monotonic() < _workers_available_until:
+        return True
+    available = cache.get(WORKER_HEARTBEAT_CACHE_KEY) is not None or cache.get(WORKERS_AVAILABLE_CACHE_KEY)
+    if available is None:
+        try:
+            available = bool(current_app.control.ping(
+                timeout=getattr(settings, 'CELERY_WORKER_PING_TIMEOUT', 0.5), limit=1))
+        except Exception:
+            django_logger.exception('Celery workers ping failed')
+            available = False
+        cache.set(WORKERS_AVAILABLE_CACHE_KEY, available, getattr(settings, 'CELERY_WORKER_AVAILABILITY_TTL', 30))
+    if available:
+        _workers_available_until = time.monotonic() + getattr(settings, 'CELERY_WORKER_AVAILABILITY_MEMO', 5)
+    return available
+
 
-    if len(list(grep2.stdout)) > 0 and not in_tests():
-        run_on_commit(lambda: task.delay(*args, **kwargs))
+def run_task(task, *args, coalesce=False, **kwargs):
+    """
+    Runs celery task asynchronously if celery workers are available, else synchronously.
+    :param coalesce: for idempotent tasks, e.g. syncing an instance to salesforce: identical runs (same task
+    and arguments) requested within one transaction are dispatched once, on commit
+    """
+    key = None
+    if coalesce:
+        try:
+            key = (task.name, args, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:  # unhashable arguments, e.g. dicts
+            key = None
+    if not in_tests() and workers_available():
+        run_on_commit(lambda: task.delay(*args, **kwargs), key=key)
     else:
-        run_on_commit(lambda: task.run(*args, **kwargs))
+        run_on_commit(lambda: task.run(*args, **kwargs), key=key)
+
+
+# start times of the tasks being executed by this worker process, by task id
+_task_started_at = {}
+
+
+@before_task_publish.connect
+def stamp_task_published_at(headers=None, **kwargs):
+    """ Custom message headers end up in task.request, the worker measures the queue wait with it """
+    if headers is not None:
+        headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, task=None, **kwargs):
+    _task_started_at[task_id] = time.monotonic()
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at:
+        # clocks of the publishing and the executing hosts may differ a bit
+        queue_wait_ms = max(time.time() - published_at, 0) * 1000
+        metrics.observe('%s%s.queue_wait_ms' % (TASK_METRICS_PREFIX, task.name), queue_wait_ms)
+
+
+@task_postrun.connect
+def record_task_end(task_id=None, task=None, state=None, **kwargs):
+    started_at = _task_started_at.pop(task_id, None)
+    if started_at is None:
+        return
+    runtime_ms = (time.monotonic() - started_at) * 1000
+    metrics.observe('%s%s.runtime_ms' % (TASK_METRICS_PREFIX, task.name), runtime_ms)
+    if state != 'RETRY':  # counted by record_task_retry
+        metrics.increment('%s%s.%s' % (TASK_METRICS_PREFIX, task.name, (state or 'unknown').lower()))
+    if runtime_ms >= getattr(settings, 'CELERY_SLOW_TASK_MS', 60000):
+        logstash_logger.warning('Slow celery task %s' % task.name, extra={
+            'task_name': task.name,
+            'task_id': task_id,
+            'state': state,
+            'runtime_ms': round(runtime_ms, 1),
+        })
+
+
+@task_retry.connect
+def record_task_retry(request=None, **kwargs):
+    metrics.increment('%s%s.retry' % (TASK_METRICS_PREFIX, request.task))
+
+
+@worker_process_shutdown.connect
+def publish_task_metrics(**kwargs):
+    """ Pool processes exit without running atexit handlers, so their last metrics are published here """
+    metrics.publish()
+
+
+def get_task_metrics():
+    """
+    Runtime, queue wait and outcome counts per task name, merged from all the processes that published their metrics
+    to the shared cache, so the admin page and the `task_metrics` command see the workers' ones.
+    Percentiles can't be merged, so the worst process' one is shown. The most time consuming tasks go first.
+    """
+    tasks = {}
+    for snapshot in get_published_metrics(TASK_METRICS_PREFIX):
+        for name, value in snapshot['counters'].items():
+            task_name, counter = name[len(TASK_METRICS_PREFIX):].rsplit('.', 1)
+            row = tasks.setdefault(task_name, {'task_name': task_name})
+            row[counter] = row.get(counter, 0) + value
+        for name, histogram in snapshot['histograms'].items():
+            task_name, metric = name[len(TASK_METRICS_PREFIX):].rsplit('.', 1)
+            merged = tasks.setdefault(task_name, {'task_name': task_name}).setdefault(metric, {'count': 0, 'sum': 0})
+            merged['count'] += histogram['count']
+            merged['sum'] += histogram['sum']
+            for key in ('p95', 'max'):
+                merged[key] = max(merged.get(key) or 0, histogram[key] or 0)
+    for row in tasks.values():
+        for metric in ('runtime_ms', 'queue_wait_ms'):
+            merged = row.setdefault(metric, {'count': 0, 'sum': 0})
+            merged['avg'] = merged['sum'] / merged['count'] if merged['count'] else None
+    return sorted(tasks.values(), key=lambda row: row['runtime_ms']['sum'], reverse=True)
+
+
+def task_metrics_view(request):
+    context = dict(admin.site.each_context(request), title='Celery task metrics', tasks=get_task_metrics(),
+                   slow_task_ms=getattr(settings, 'CELERY_SLOW_TASK_MS', 60000))
+    return render(request, 'general/admin/task_metrics.html', context)
+
+
+def task_result_get_urls(self):
+    return [url(r'^metrics/$', self.admin_site.admin_view(task_metrics_view), name='task_metrics')] \
+           + super(self.__class__, self).get_urls()
+
+
+TaskResultAdmin.get_urls = task_result_get_urls
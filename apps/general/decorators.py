@@ -44,14 +44,28 @@ def is_staff_or_superuser(view_func=None, redirect_field_name=REDIRECT_FIELD_NAM
     return actual_decorator
 
 
-def run_on_commit(lambda_func: Callable):
+def run_on_commit(lambda_func: Callable, key=None):
     """
     Makes sure the func would be called only after the OUTERMOST transaction's been committed.
     :param lambda_func: a function without arguments
+    :param key: a hashable; calls with the same key within one outermost transaction are coalesced into the first one
     Usage:
         run_on_commit(lambda: run_task(send_booking_updated, instance.id))
     """
     if in_tests():
         return lambda_func()
-    with transaction.atomic():
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return lambda_func()  # nothing to wait for
+
+    if key is not None:
+        # the pending callbacks of rolled back savepoints are already discarded from the list
+        if any(getattr(func, 'coalesce_key', None) == key for _, func in connection.run_on_commit):
+            return
+
+        def callback():
+            lambda_func()
+        callback.coalesce_key = key
+        transaction.on_commit(callback)
+    else:
         transaction.on_commit(lambda_func)
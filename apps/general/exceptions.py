@@ -37,5 +37,17 @@ class ValidationErrorException(AppException):
     code = 'validation_error'
 
 
+class PersistedQueryNotFoundException(AppException):
+    code = 'persisted_query_not_found'
+
+
+class OperationTimeoutException(AppException):
+    code = 'timeout'
+
+
+class QueryTooComplexException(AppException):
+    code = 'query_too_complex'
+
+
 class InvalidPhoneNumber(Exception):
     pass
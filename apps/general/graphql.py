@@ -1,9 +1,27 @@
 import datetime
-from collections import OrderedDict, Iterable
+import hashlib
+import json
+import random
+import threading
+import uuid
+import time
+from collections import OrderedDict, Iterable, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from copy import copy
 from decimal import Decimal
 
 import graphene
 import graphene_django.views
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, connection
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.http.response import HttpResponseBadRequest
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import ensure_csrf_cookie
+from graphene_django.views import HttpError
 from graphene.types import String, Int, Float, Boolean
 from graphene.types import Union
 from graphene.types.datetime import DateTime, Time, Scalar
@@ -16,12 +34,27 @@ from graphene.types.union import UnionMeta
 from graphene.utils.is_base_type import is_base_type
 from graphene.utils.str_converters import to_camel_case
 from graphene.utils.trim_docstring import trim_docstring
-from graphql.error import GraphQLError
+from graphql import Source, parse, validate
+from graphql.error import GraphQLError, GraphQLLocatedError
 from graphql.error import format_error as format_graphql_error
-from graphql.language.ast import StringValue
-
-from apps.general.exceptions import AppException, InternalErrorException, ErrorDto
+from graphql.execution import ExecutionResult
+from graphql.language.ast import StringValue, Field, FragmentSpread, FragmentDefinition, IntValue, \
+    Variable
+from graphql.language.printer import print_ast
+from graphql.type.definition import GraphQLList, GraphQLNonNull, get_named_type
+from graphql.utils.get_field_def import get_field_def
+from graphql.utils.get_operation_ast import get_operation_ast
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from apps.general.exceptions import (
+    AppException, InternalErrorException, ErrorDto, InvalidParamException, PersistedQueryNotFoundException,
+    OperationTimeoutException, QueryTooComplexException,
+)
+from apps.general.loggers import logstash_logger
 from apps.general.metautils import mix_meta_factory
+from apps.general.metrics import metrics
+from apps.general.utils import in_tests
 
 
 class MixableEnum(graphene.Enum, metaclass=mix_meta_factory(EnumTypeMeta)):
@@ -165,18 +198,505 @@ def format_error(error):
     return {'message': str(error)}
 
 
+def app_error_result(exc, invalid=False):
+    """ Wraps an AppException into an ExecutionResult, so it's rendered by `format_error` with its code """
+    return ExecutionResult(errors=[GraphQLLocatedError(nodes=None, original_error=exc)], invalid=invalid)
+
+
+def hash_query(query):
+    return hashlib.sha256(query.encode('utf8')).hexdigest()
+
+
+class DocumentCache:
+    """ Thread-safe bounded LRU of parsed and validated query documents """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            document_ast = self._documents.get(key)
+            if document_ast is not None:
+                self._documents.move_to_end(key)
+            return document_ast
+
+    def set(self, key, document_ast):
+        with self._lock:
+            self._documents[key] = document_ast
+            self._documents.move_to_end(key)
+            while len(self._documents) > self.max_size:
+                self._documents.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+
+def get_graphql_cache():
+    """ The cache of responses and registered persisted queries, apart from the default one (settings.GRAPHQL_CACHE) """
+    return caches[getattr(settings, 'GRAPHQL_CACHE', 'default')]
+
+
+class PersistedQueryRegistry:
+    """
+    Maps sha256 hashes to query texts.
+    Queries come from the manifest generated at deploy time (settings.GRAPHQL_PERSISTED_QUERIES_FILE,
+    a JSON object of {hash: query}) or, without a manifest, from clients registering them on the fly
+    (Apollo "automatic persisted queries" protocol). The latter are shared between processes
+    via `get_graphql_cache()` and expire after settings.GRAPHQL_PERSISTED_QUERIES_TIMEOUT seconds.
+    """
+    cache_key = 'graphql_persisted_query_%s'
+
+    def __init__(self, manifest_file=None):
+        self._queries = None
+        if manifest_file:
+            with open(manifest_file) as f:
+                self._queries = json.load(f)
+
+    def get(self, query_hash):
+        if self._queries is not None:
+            return self._queries.get(query_hash)
+        return get_graphql_cache().get(self.cache_key % query_hash)
+
+    def register(self, query_hash, query):
+        """ Only without a manifest, so the clients can't fill the cache with queries of their own """
+        if self._queries is None:
+            get_graphql_cache().set(
+                self.cache_key % query_hash, query, getattr(settings, 'GRAPHQL_PERSISTED_QUERIES_TIMEOUT', 86400))
+
+
+def _run_operation(fn, item):
+    """ Pool threads keep their own DB connections; recycle them the same way Django does between requests """
+    close_old_connections()
+    try:
+        return fn(item)
+    finally:
+        close_old_connections()
+
+
+class BatchExecutor:
+    """
+    Runs the operations of a batched request concurrently in a process-wide thread pool.
+    At most `max_concurrency` operations of one batch run at a time, and the whole batch has `deadline` seconds.
+    """
+
+    def __init__(self, max_workers, max_concurrency, deadline):
+        self.max_concurrency = max_concurrency
+        self.deadline = deadline
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def map(self, fn, items):
+        """ Returns a future per item, in order. Items that didn't finish before the deadline get None """
+        futures = [None] * len(items)
+        pending = {}
+        queue = iter(enumerate(items))
+        deadline_at = time.monotonic() + self.deadline
+
+        def submit_next():
+            for index, item in queue:
+                pending[self._pool.submit(_run_operation, fn, item)] = index
+                return
+
+        for _ in range(self.max_concurrency):
+            submit_next()
+        while pending:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures[pending.pop(future)] = future
+                submit_next()
+        for future in pending:
+            future.cancel()
+        return futures
+
+
+class ModelLoader(DataLoader):
+    """
+    Coalesces `Model.objects.get(<field>=key)` lookups made during one execution tick
+    into a single `Model.objects.filter(<field>__in=keys)` query.
+    With many=True, resolves each key to the list of all matching objects (e.g. residents by `property_id`).
+    """
+
+    def __init__(self, model, field='pk', many=False):
+        self.model = model
+        self.field = field
+        self.many = many
+        self._model_field = model._meta.pk if field == 'pk' else model._meta.get_field(field)
+        super().__init__()
+
+    def get_cache_key(self, key):
+        # Ids may come as strings from query arguments and as ints from model instances
+        return self._model_field.to_python(key)
+
+    def batch_load_fn(self, keys):
+        keys = [self.get_cache_key(key) for key in keys]
+        found = {}
+        for obj in self.model._default_manager.filter(**{'%s__in' % self.field: keys}):
+            value = getattr(obj, self._model_field.attname)
+            if self.many:
+                found.setdefault(value, []).append(obj)
+            else:
+                found[value] = obj
+        return Promise.resolve([found.get(key, [] if self.many else None) for key in keys])
+
+
+class DataLoaders:
+    """
+    Request-scoped registry of loaders, created by GraphQLView and available to resolvers as `context.dataloaders`.
+    Usage:
+        def resolve_property(self, args, context, info):
+            return context.dataloaders.for_model(Property).load(self.property_id)
+    """
+
+    def __init__(self):
+        self._loaders = {}
+
+    def for_model(self, model, field='pk', many=False):
+        key = (model, field, many)
+        if key not in self._loaders:
+            self._loaders[key] = ModelLoader(model, field=field, many=many)
+        return self._loaders[key]
+
+    def load_related(self, instance, field_name):
+        """ Batched replacement for `instance.<foreign key>`. Returns a promise (or None for an empty relation) """
+        field = instance._meta.get_field(field_name)
+        related_id = getattr(instance, field.attname)
+        if related_id is None:
+            return None
+        target_field = field.target_field
+        return self.for_model(
+            field.related_model, field='pk' if target_field.primary_key else target_field.name).load(related_id)
+
+
+QueryCost = namedtuple('QueryCost', ['cost', 'depth'])
+
+
+class QueryCostAnalyzer:
+    """
+    Statically estimates the cost of an operation before it's executed.
+    Every field costs settings.GRAPHQL_FIELD_COSTS['Type.field'] (settings.GRAPHQL_DEFAULT_FIELD_COST by default).
+    Selections under a list field are multiplied by its `first`/`last`/`limit` argument
+    or by settings.GRAPHQL_LIST_MULTIPLIER when the page size is unknown. Introspection fields cost nothing.
+    """
+    page_size_arguments = ('first', 'last', 'limit')
+
+    def __init__(self, schema, document_ast, variables=None):
+        self.schema = schema
+        self.document_ast = document_ast
+        self.variables = variables or {}
+        self.field_costs = getattr(settings, 'GRAPHQL_FIELD_COSTS', {})
+        self.default_field_cost = getattr(settings, 'GRAPHQL_DEFAULT_FIELD_COST', 1)
+        self.list_multiplier = getattr(settings, 'GRAPHQL_LIST_MULTIPLIER', 10)
+        self.fragments = {
+            definition.name.value: definition for definition in document_ast.definitions
+            if isinstance(definition, FragmentDefinition)
+        }
+
+    def analyze(self, operation_name=None):
+        operation_ast = get_operation_ast(self.document_ast, operation_name)
+        if operation_ast is None:
+            return QueryCost(cost=0, depth=0)
+        root_type = {
+            'query': self.schema.get_query_type,
+            'mutation': self.schema.get_mutation_type,
+            'subscription': self.schema.get_subscription_type,
+        }[operation_ast.operation]()
+        return QueryCost(*self._selection_set_cost(operation_ast.selection_set, root_type, depth=0))
+
+    def _selection_set_cost(self, selection_set, parent_type, depth, page_size=None):
+        cost, max_depth = 0, depth
+        for selection in selection_set.selections:
+            if isinstance(selection, Field):
+                selection_cost, selection_depth = self._field_cost(selection, parent_type, depth + 1, page_size)
+            else:
+                if isinstance(selection, FragmentSpread):
+                    selection = self.fragments[selection.name.value]
+                fragment_type = parent_type
+                if selection.type_condition:
+                    fragment_type = self.schema.get_type(selection.type_condition.name.value)
+                selection_cost, selection_depth = self._selection_set_cost(
+                    selection.selection_set, fragment_type, depth, page_size)
+            cost += selection_cost
+            max_depth = max(max_depth, selection_depth)
+        return cost, max_depth
+
+    def _field_cost(self, field_ast, parent_type, depth, page_size=None):
+        if field_ast.name.value.startswith('__'):
+            # Introspection (__schema, __type, __typename) is free, it's served by GraphiQL and codegen tooling
+            return 0, depth - 1
+        field_def = get_field_def(self.schema, parent_type, field_ast)
+        if field_def is None:
+            return 0, depth
+        cost = self.field_costs.get('%s.%s' % (parent_type.name, field_ast.name.value), self.default_field_cost)
+        if not field_ast.selection_set:
+            return cost, depth
+
+        # A page size of a connection field applies to the list (`edges`) nested inside it
+        page_size = self._get_page_size(field_ast) or page_size
+        multiplier = 1
+        field_type = field_def.type
+        while isinstance(field_type, (GraphQLList, GraphQLNonNull)):
+            if isinstance(field_type, GraphQLList):
+                multiplier *= page_size or self.list_multiplier
+                page_size = None
+            field_type = field_type.of_type
+
+        children_cost, depth = self._selection_set_cost(field_ast.selection_set, get_named_type(field_type), depth,
+                                                        page_size)
+        return cost + multiplier * children_cost, depth
+
+    def _get_page_size(self, field_ast):
+        for argument in field_ast.arguments or []:
+            if argument.name.value not in self.page_size_arguments:
+                continue
+            value = argument.value
+            if isinstance(value, Variable):
+                value = self.variables.get(value.name.value)
+            elif isinstance(value, IntValue):
+                value = value.value
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return None
+
+
+class _QueryStats:
+    """ `connection.execute_wrapper()` callback counting queries and their time """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+class ResolverTimingMiddleware:
+    """
+    Opt-in graphene middleware recording wall time, DB query count and DB time per resolver ("Type.field")
+    into `apps.general.metrics`. Enable it in settings.GRAPHENE['MIDDLEWARE'].
+    Only settings.GRAPHQL_RESOLVER_TIMING_SAMPLE_RATE of the requests are measured;
+    resolvers slower than settings.GRAPHQL_SLOW_RESOLVER_MS are logged.
+    Time spent by nested resolvers isn't included, as they run after their parent has returned.
+    """
+
+    def __init__(self):
+        self.sample_rate = getattr(settings, 'GRAPHQL_RESOLVER_TIMING_SAMPLE_RATE', 0.1)
+        self.slow_resolver_ms = getattr(settings, 'GRAPHQL_SLOW_RESOLVER_MS', 500)
+
+    def is_sampled(self, context):
+        sampled = getattr(context, 'resolver_timing_sampled', None)
+        if sampled is None:
+            sampled = random.random() < self.sample_rate
+            try:
+                context.resolver_timing_sampled = sampled
+            except AttributeError:
+                pass  # no request context, e.g. in schema.execute()
+        return sampled
+
+    def resolve(self, next, root, args, context, info):
+        if not self.is_sampled(context):
+            return next(root, args, context, info)
+
+        query_stats = _QueryStats()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(query_stats):
+                return next(root, args, context, info)
+        finally:
+            self.record('%s.%s' % (info.parent_type.name, info.field_name),
+                        (time.perf_counter() - start) * 1000, query_stats)
+
+    def record(self, path, duration_ms, query_stats):
+        db_time_ms = query_stats.duration * 1000
+        metrics.observe('graphql.resolver.%s.time_ms' % path, duration_ms)
+        metrics.observe('graphql.resolver.%s.db_queries' % path, query_stats.count)
+        metrics.observe('graphql.resolver.%s.db_time_ms' % path, db_time_ms)
+        if duration_ms >= self.slow_resolver_ms:
+            logstash_logger.warning('Slow GraphQL resolver %s' % path, extra={
+                'resolver': path,
+                'duration_ms': round(duration_ms, 1),
+                'db_queries': query_stats.count,
+                'db_time_ms': round(db_time_ms, 1),
+            })
+
+
+class ResponseCache:
+    """
+    Caches results of the queries listed in settings.GRAPHQL_RESPONSE_CACHE_FIELDS in `get_graphql_cache()`,
+    which settings.CACHES shares between the processes, so an invalidation reaches all of them.
+    Every entry is tagged with the models declared for its fields; `post_save`/`post_delete` of such a model
+    bumps the version of its tag, which turns the entries into misses. The versions are read before the query
+    is executed, so a change made during the execution invalidates the entry being stored too.
+    Changes made with `QuerySet.update()` don't send signals, so they're only picked up after the timeout.
+    """
+    key_prefix = 'graphql_response_%s'
+    tag_key_prefix = 'graphql_response_tag_%s'
+
+    def get(self, key):
+        entry = get_graphql_cache().get(self.key_prefix % key)
+        if entry is None:
+            return None
+        data, tag_versions = entry
+        return data if self.get_tag_versions(tag_versions) == tag_versions else None
+
+    def get_tag_versions(self, tags):
+        """ Current versions of the tags, the missing ones are created """
+        cache = get_graphql_cache()
+        tag_keys = {tag: self.tag_key_prefix % tag for tag in tags}
+        versions = cache.get_many(list(tag_keys.values()))
+        for tag, tag_key in tag_keys.items():
+            if tag_key not in versions:
+                cache.add(tag_key, uuid.uuid4().hex, None)
+                versions[tag_key] = cache.get(tag_key)
+        return {tag: versions[tag_key] for tag, tag_key in tag_keys.items()}
+
+    def set(self, key, data, tag_versions, timeout):
+        """ `tag_versions` must be taken by `get_tag_versions` before the data was read """
+        get_graphql_cache().set(self.key_prefix % key, (data, tag_versions), timeout)
+
+    def invalidate(self, tag):
+        get_graphql_cache().set(self.tag_key_prefix % tag, uuid.uuid4().hex, None)
+
+
+response_cache = ResponseCache()
+
+
+def get_response_cache_models():
+    """ The models declared by settings.GRAPHQL_RESPONSE_CACHE_FIELDS """
+    return {django_apps.get_model(model) for policy in getattr(settings, 'GRAPHQL_RESPONSE_CACHE_FIELDS', {}).values()
+            for model in policy.get('models', ())}
+
+
+def invalidate_cached_responses(sender, **kwargs):
+    response_cache.invalidate(sender._meta.db_table)
+    metrics.increment('graphql.response_cache.invalidation')
+
+
+def connect_response_cache_signals():
+    """ Only the declared models invalidate, saves of the other ones don't touch the cache """
+    for model in get_response_cache_models():
+        post_save.connect(invalidate_cached_responses, sender=model,
+                          dispatch_uid='graphql_response_cache_post_save_%s' % model._meta.label_lower)
+        post_delete.connect(invalidate_cached_responses, sender=model,
+                            dispatch_uid='graphql_response_cache_post_delete_%s' % model._meta.label_lower)
+
+
+_document_cache = None
+_persisted_query_registry = None
+_batch_executor = None
+
+
+def get_document_cache():
+    global _document_cache
+    if _document_cache is None:
+        _document_cache = DocumentCache(max_size=getattr(settings, 'GRAPHQL_DOCUMENT_CACHE_SIZE', 500))
+    return _document_cache
+
+
+def get_persisted_query_registry():
+    global _persisted_query_registry
+    if _persisted_query_registry is None:
+        _persisted_query_registry = PersistedQueryRegistry(getattr(settings, 'GRAPHQL_PERSISTED_QUERIES_FILE', None))
+    return _persisted_query_registry
+
+
+def get_batch_executor():
+    """ Returns None when concurrent batch execution is disabled (settings.GRAPHQL_BATCH_WORKERS = 0) """
+    global _batch_executor
+    if _batch_executor is None and getattr(settings, 'GRAPHQL_BATCH_WORKERS', 0):
+        _batch_executor = BatchExecutor(
+            max_workers=settings.GRAPHQL_BATCH_WORKERS,
+            max_concurrency=getattr(settings, 'GRAPHQL_BATCH_CONCURRENCY', settings.GRAPHQL_BATCH_WORKERS),
+            deadline=getattr(settings, 'GRAPHQL_BATCH_DEADLINE', 30),
+        )
+    return _batch_executor
+
+
 class GraphQLView(graphene_django.views.GraphQLView):
     @staticmethod
     def format_error(error):
         return format_error(error)
 
     def dispatch(self, request, *args, **kwargs):
+        # Shared (not copied) by the operations of a concurrent batch
+        request.graphql_costs = []
+        response = None
         if request.method.lower() in ('get', 'post'):
             data = self.parse_body(request)
             # Disable batch mode if received an unsuitable request.
             if isinstance(data, dict) or not isinstance(data, Iterable):
                 self.batch = False
-        return super().dispatch(request, *args, **kwargs)
+            elif self.batch and self.can_execute_concurrently(request, data):
+                response = self.dispatch_concurrent_batch(request, data)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+        if request.graphql_costs:
+            response['X-GraphQL-Cost'] = str(sum(request.graphql_costs))
+        return response
+
+    def can_execute_concurrently(self, request, data):
+        """ Only batches of queries run concurrently, mutations keep their sequential order """
+        if get_batch_executor() is None or len(data) < 2 or in_tests():
+            return False
+        for entry in data:
+            try:
+                query, variables, operation_name, id = self.get_graphql_params(request, entry)
+                document_ast, validation_errors = self.get_document(
+                    query, self.get_persisted_query_hash(request, entry))
+            except Exception:
+                return False
+            if validation_errors:
+                return False
+            operation_ast = get_operation_ast(document_ast, operation_name)
+            if not operation_ast or operation_ast.operation != 'query':
+                return False
+        return True
+
+    @method_decorator(ensure_csrf_cookie)
+    def dispatch_concurrent_batch(self, request, data):
+        if hasattr(request, 'user'):
+            # Resolve the lazy user once, so the pool threads share a ready request object.
+            request.user.is_authenticated
+        try:
+            # Every operation gets its own copy of the request to keep request-scoped state (dataloaders) apart
+            futures = get_batch_executor().map(lambda entry: self.get_response(copy(request), entry), data)
+            responses = [
+                future.result() if future is not None else self.get_timeout_response(request, entry)
+                for future, entry in zip(futures, data)
+            ]
+        except HttpError as e:
+            response = e.response
+            response['Content-Type'] = 'application/json'
+            response.content = self.json_encode(request, {
+                'errors': [self.format_error(e)]
+            })
+            return response
+
+        return HttpResponse(
+            status=max(response[1] for response in responses),
+            content='[{}]'.format(','.join([response[0] for response in responses])),
+            content_type='application/json'
+        )
+
+    def get_timeout_response(self, request, data):
+        status_code = 504
+        error = GraphQLLocatedError(nodes=None, original_error=OperationTimeoutException(
+            detail='The operation did not finish within the batch deadline.'))
+        return self.json_encode(request, {
+            'errors': [self.format_error(error)],
+            'id': self.get_graphql_params(request, data)[3],
+            'status': status_code,
+        }), status_code
 
     def parse_body(self, request):
         # To not parse twice.
@@ -185,6 +705,189 @@ class GraphQLView(graphene_django.views.GraphQLView):
             setattr(request, '_parsed_data', data)
         return getattr(request, '_parsed_data')
 
+    def get_context(self, request):
+        if getattr(request, 'dataloaders', None) is None:
+            request.dataloaders = DataLoaders()
+        return request
+
+    @staticmethod
+    def get_persisted_query_hash(request, data):
+        """ Extracts the hash sent as `{"extensions": {"persistedQuery": {"sha256Hash": ...}}}` """
+        extensions = request.GET.get('extensions') or data.get('extensions')
+        if extensions and isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest('Extensions are invalid JSON.'))
+        if not isinstance(extensions, dict):
+            return None
+        return (extensions.get('persistedQuery') or {}).get('sha256Hash')
+
+    def get_document(self, query, query_hash=None):
+        """
+        Returns (document_ast, validation_errors).
+        Parsing and validation happen once per distinct query, then the document is served from the LRU.
+        """
+        if query:
+            actual_hash = hash_query(query)
+            if query_hash and query_hash != actual_hash:
+                raise InvalidParamException(detail='Provided sha256Hash does not match the query.')
+            register = bool(query_hash)
+            query_hash = actual_hash
+        else:
+            register = False
+
+        document_cache = get_document_cache()
+        cache_key = (id(self.schema), query_hash)
+        document_ast = document_cache.get(cache_key)
+        if document_ast is not None:
+            return document_ast, None
+
+        registry = get_persisted_query_registry()
+        if not query:
+            query = registry.get(query_hash)
+            if query is None:
+                raise PersistedQueryNotFoundException(detail='PersistedQueryNotFound')
+
+        document_ast = parse(Source(query, name='GraphQL request'))
+        validation_errors = validate(self.schema, document_ast)
+        if validation_errors:
+            return None, validation_errors
+        document_cache.set(cache_key, document_ast)
+        if register:
+            registry.register(query_hash, query)
+        return document_ast, None
+
+    def check_query_cost(self, request, document_ast, operation_name, variables):
+        """
+        Rejects operations above settings.GRAPHQL_MAX_QUERY_COST / GRAPHQL_MAX_QUERY_DEPTH.
+        With settings.GRAPHQL_ENFORCE_QUERY_COST = False offenders are only logged.
+        """
+        query_cost = QueryCostAnalyzer(self.schema, document_ast, variables).analyze(operation_name)
+        if hasattr(request, 'graphql_costs'):
+            request.graphql_costs.append(query_cost.cost)
+        metrics.observe('graphql.query_cost', query_cost.cost)
+
+        errors = []
+        max_cost = getattr(settings, 'GRAPHQL_MAX_QUERY_COST', None)
+        if max_cost is not None and query_cost.cost > max_cost:
+            errors.append(ErrorDto(key='cost', message='Query cost %s exceeds %s.' % (query_cost.cost, max_cost)))
+        max_depth = getattr(settings, 'GRAPHQL_MAX_QUERY_DEPTH', None)
+        if max_depth is not None and query_cost.depth > max_depth:
+            errors.append(ErrorDto(key='depth', message='Query depth %s exceeds %s.' % (query_cost.depth, max_depth)))
+        if not errors:
+            return query_cost
+
+        metrics.increment('graphql.query_cost.over_budget')
+        logstash_logger.warning('GraphQL query over budget', extra={
+            'operation_name': operation_name,
+            'query_cost': query_cost.cost,
+            'query_depth': query_cost.depth,
+        })
+        if getattr(settings, 'GRAPHQL_ENFORCE_QUERY_COST', True):
+            raise QueryTooComplexException(detail='Query is too complex.', errors=errors)
+        return query_cost
+
+    def execute_graphql_request(self, request, data, query, variables, operation_name, show_graphiql=False):
+        query_hash = self.get_persisted_query_hash(request, data)
+        if not query and not query_hash:
+            return super().execute_graphql_request(request, data, query, variables, operation_name, show_graphiql)
+
+        try:
+            document_ast, validation_errors = self.get_document(query, query_hash)
+        except AppException as e:
+            return app_error_result(e, invalid=not isinstance(e, PersistedQueryNotFoundException))
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+        if validation_errors:
+            return ExecutionResult(errors=validation_errors, invalid=True)
+
+        try:
+            self.check_query_cost(request, document_ast, operation_name, variables)
+        except QueryTooComplexException as e:
+            return app_error_result(e, invalid=True)
+
+        if request.method.lower() == 'get':
+            operation_ast = get_operation_ast(document_ast, operation_name)
+            if operation_ast and operation_ast.operation != 'query':
+                if show_graphiql:
+                    return None
+                raise HttpError(HttpResponseNotAllowed(
+                    ['POST'], 'Can only perform a {} operation from a POST request.'.format(operation_ast.operation)
+                ))
+
+        try:
+            cache_policy = self.get_response_cache_policy(document_ast, operation_name)
+            if cache_policy:
+                return self.execute_cached(request, document_ast, variables, operation_name, cache_policy)
+            return self.execute_document(request, document_ast, variables, operation_name)
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+    def execute_document(self, request, document_ast, variables, operation_name):
+        return self.execute(
+            document_ast,
+            root_value=self.get_root_value(request),
+            variable_values=variables,
+            operation_name=operation_name,
+            context_value=self.get_context(request),
+            middleware=self.get_middleware(request),
+            executor=self.executor,
+        )
+
+    @staticmethod
+    def get_response_cache_policy(document_ast, operation_name):
+        """
+        A query is cacheable if all its root fields are listed in settings.GRAPHQL_RESPONSE_CACHE_FIELDS:
+            {'fieldName': {'timeout': 300, 'scope': 'public' or 'user', 'models': ['app_label.ModelName']}}
+        Returns the merged policy (the shortest timeout, the narrowest scope) or None.
+        """
+        cacheable_fields = getattr(settings, 'GRAPHQL_RESPONSE_CACHE_FIELDS', None)
+        if not cacheable_fields:
+            return None
+        operation_ast = get_operation_ast(document_ast, operation_name)
+        if not operation_ast or operation_ast.operation != 'query':
+            return None
+        policy = {'timeout': None, 'scope': 'public', 'models': set()}
+        for selection in operation_ast.selection_set.selections:
+            if not isinstance(selection, Field):
+                return None
+            if selection.name.value == '__typename':
+                continue
+            field_policy = cacheable_fields.get(selection.name.value)
+            if field_policy is None:
+                return None
+            timeout = field_policy.get('timeout', 300)
+            policy['timeout'] = timeout if policy['timeout'] is None else min(policy['timeout'], timeout)
+            if field_policy.get('scope', 'public') != 'public':
+                policy['scope'] = 'user'
+            policy['models'].update(field_policy.get('models', ()))
+        return policy if policy['timeout'] is not None else None
+
+    def execute_cached(self, request, document_ast, variables, operation_name, cache_policy):
+        user = getattr(request, 'user', None)
+        if cache_policy['scope'] == 'user':
+            if user is None or not user.is_authenticated:
+                return self.execute_document(request, document_ast, variables, operation_name)
+            scope = 'user:%s' % user.pk
+        else:
+            scope = 'public'
+        cache_key = hash_query(json.dumps(
+            [print_ast(document_ast), operation_name, variables, scope], sort_keys=True, default=str))
+
+        data = response_cache.get(cache_key)
+        if data is not None:
+            metrics.increment('graphql.response_cache.hit')
+            return ExecutionResult(data=data)
+        metrics.increment('graphql.response_cache.miss')
+
+        tag_versions = response_cache.get_tag_versions(
+            {django_apps.get_model(model)._meta.db_table for model in cache_policy['models']})
+        result = self.execute_document(request, document_ast, variables, operation_name)
+        if not result.errors and not result.invalid:
+            response_cache.set(cache_key, result.data, tag_versions, cache_policy['timeout'])
+        return result
+
 
 def construct_dynamic_graphene_object(obj_name, fields_dict, force_camel_case=True):
     """ Creates an instance of graphene.ObjectType with dynamically-specified fields
@@ -0,0 +1,20 @@
+import json
+
+from django.core.management import BaseCommand
+
+from apps.general.metrics import get_published_metrics
+
+
+class Command(BaseCommand):
+    help = "Print the in-process metrics (GraphQL resolver timings, celery tasks, caches) published by all processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('prefix', nargs='?', default='', type=str,
+                            help='Only show metrics starting with this prefix, e.g. "graphql.resolver."')
+
+    def handle(self, *args, **options):
+        snapshots = get_published_metrics(options['prefix'])
+        if not snapshots:
+            self.stdout.write("No metrics published yet. Make sure the cache is shared between processes.")
+            return
+        self.stdout.write(json.dumps(snapshots, indent=2, sort_keys=True))
@@ -0,0 +1,14 @@
+from django.core.management import BaseCommand
+
+from apps.general.celery import prune_task_results
+
+
+class Command(BaseCommand):
+    help = "Delete celery task results older than the CELERY_TASK_RESULT_EXPIRES dynamic setting"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None, help='Results deleted per transaction')
+
+    def handle(self, *args, **options):
+        deleted = prune_task_results(options['chunk_size'])
+        self.stdout.write("Deleted %s task results" % deleted)
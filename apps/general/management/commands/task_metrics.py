@@ -0,0 +1,25 @@
+from django.core.management import BaseCommand
+
+from apps.general.celery import get_task_metrics
+
+
+def _ms(value):
+    return '-' if value is None else '%.0f' % value
+
+
+class Command(BaseCommand):
+    help = "Print celery task runtimes, queue waits and outcomes published by all workers, most time consuming first"
+
+    def handle(self, *args, **options):
+        tasks = get_task_metrics()
+        if not tasks:
+            self.stdout.write("No task metrics published yet. Make sure the cache is shared between processes.")
+            return
+        self.stdout.write('%-60s %8s %12s %8s %8s %8s %12s %8s %8s' % (
+            'task', 'runs', 'total ms', 'avg ms', 'p95 ms', 'max ms', 'avg wait ms', 'failed', 'retried'))
+        for task in tasks:
+            runtime, queue_wait = task['runtime_ms'], task['queue_wait_ms']
+            self.stdout.write('%-60s %8s %12s %8s %8s %8s %12s %8s %8s' % (
+                task['task_name'], runtime['count'], _ms(runtime['sum']), _ms(runtime['avg']),
+                _ms(runtime.get('p95')), _ms(runtime.get('max')), _ms(queue_wait['avg']),
+                task.get('failure', 0), task.get('retry', 0)))
@@ -0,0 +1,139 @@
+"""
+In-process metrics: counters and histograms aggregated per process (per gunicorn/celery worker).
+They are cheap to update on hot paths and can be read through `metrics.snapshot()`.
+Every process also publishes its snapshot to the default cache, which settings.CACHES shares between the gunicorn
+and celery processes: on its first metric, then once per settings.METRICS_PUBLISH_INTERVAL seconds and at exit.
+So `get_published_metrics()` (the `dump_metrics` command, the staff metrics page) can show all of them.
+"""
+import atexit
+import bisect
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Upper bounds of the histogram buckets, e.g. milliseconds or query cost units
+DEFAULT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is for values above the largest bucket
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """ Upper bound of the bucket the given percentile falls into """
+        if not self.count:
+            return None
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= threshold:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'avg': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class MetricsRegistry:
+    index_cache_key = 'metrics_processes'
+    process_cache_key = 'metrics_%s_%s'
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._published_at = None
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        self._maybe_publish()
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+        self._maybe_publish()
+
+    def snapshot(self, prefix=''):
+        with self._lock:
+            return {
+                'counters': {k: v for k, v in sorted(self._counters.items()) if k.startswith(prefix)},
+                'histograms': {k: v.as_dict() for k, v in sorted(self._histograms.items()) if k.startswith(prefix)},
+            }
+
+    def reset(self, prefix=''):
+        with self._lock:
+            for storage in (self._counters, self._histograms):
+                for key in [k for k in storage if k.startswith(prefix)]:
+                    del storage[key]
+
+    def publish(self):
+        """ Stores this process' snapshot in the cache """
+        self._published_at = time.monotonic()
+        interval = getattr(settings, 'METRICS_PUBLISH_INTERVAL', 60)
+        process = '%s:%s' % (socket.gethostname(), os.getpid())
+        key = self.process_cache_key % (socket.gethostname(), os.getpid())
+        snapshot = self.snapshot()
+        try:
+            if not snapshot['counters'] and not snapshot['histograms']:
+                cache.delete(key)  # e.g. after a reset
+                return
+            snapshot.update({'process': process, 'published_at': time.time()})
+            cache.set(key, snapshot, interval * 10)
+            index = cache.get(self.index_cache_key) or []
+            if key not in index:
+                cache.set(self.index_cache_key, [k for k in index if cache.get(k) is not None] + [key], None)
+        except Exception:
+            pass  # metrics must never break the code being measured
+
+    def _maybe_publish(self):
+        if self._published_at is None or \
+                time.monotonic() - self._published_at >= getattr(settings, 'METRICS_PUBLISH_INTERVAL', 60):
+            self.publish()
+
+
+metrics = MetricsRegistry()
+atexit.register(metrics.publish)
+
+
+def get_published_metrics(prefix=''):
+    """ Snapshots of all processes that published recently, the current process' one is always fresh """
+    metrics.publish()
+    result = []
+    for key in cache.get(MetricsRegistry.index_cache_key) or []:
+        snapshot = cache.get(key)
+        if snapshot is None:
+            continue
+        for kind in ('counters', 'histograms'):
+            snapshot[kind] = {k: v for k, v in snapshot[kind].items() if k.startswith(prefix)}
+        result.append(snapshot)
+    return result
@@ -8,7 +8,10 @@ from django.utils.deprecation import MiddlewareMixin
 class AddReleaseIdToResponseMiddleware(MiddlewareMixin):
     def process_response(self, _, response):
         response['x-release-git-sha'] = settings.RELEASE_GIT_SHA.split('-')[-1]
-        response['Access-Control-Expose-Headers'] = 'x-release-git-sha'
+        exposed_headers = [response.get('Access-Control-Expose-Headers'), 'x-release-git-sha']
+        if response.has_header('X-GraphQL-Cost'):
+            exposed_headers.append('x-graphql-cost')
+        response['Access-Control-Expose-Headers'] = ', '.join(filter(None, exposed_headers))
         return response
 
 
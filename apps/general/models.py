@@ -7,3 +7,40 @@ class BaseCreatedModifiedModel(models.Model):
 
     class Meta:
         abstract = True
+
+
+class TaskResultName(models.Model):
+    """ Name of the task of a django_celery_results TaskResult, indexed instead of being parsed from its `meta` """
+    task_result = models.OneToOneField('django_celery_results.TaskResult', on_delete=models.CASCADE,
+                                       primary_key=True, related_name='task_name_info')
+    task_name = models.CharField(max_length=255, null=True, db_index=True)
+
+
+class OutboundNotification(BaseCreatedModifiedModel):
+    """ An email, SMS or push message waiting in the outbox, see `apps.general.outbox` """
+    CHANNEL_EMAIL = 'email'
+    CHANNEL_SMS = 'sms'
+    CHANNEL_PUSH = 'push'
+    CHANNEL_CHOICES = ((CHANNEL_EMAIL, 'Email'), (CHANNEL_SMS, 'SMS'), (CHANNEL_PUSH, 'Push'))
+
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = ((STATUS_PENDING, 'Pending'), (STATUS_SENT, 'Sent'), (STATUS_FAILED, 'Failed'))
+
+    channel = models.CharField(max_length=10, choices=CHANNEL_CHOICES)
+    method = models.CharField(max_length=50)  # the sender's method, e.g. send_sms
+    payload = models.TextField()  # JSON of the method's args and kwargs and of the sender factory's kwargs
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True, unique=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # due pending notifications are sent; a worker sending one moves it into the future, so it's retried if it dies
+    next_attempt_at = models.DateTimeField(db_index=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        index_together = [('status', 'next_attempt_at')]
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.channel, self.method, self.status)
@@ -0,0 +1,203 @@
+"""
+Durable outbox of emails, SMS and push messages.
+`get_mandrill_mailer(queued=True)`, `get_sms_sender(queued=True)` and `get_push_sender(queued=True)` return
+a QueuedSender: its send methods only store an OutboundNotification and hand `drain_notification_outbox`
+over to a worker, which sends the due notifications by settings.NOTIFICATION_OUTBOX_CONCURRENCY threads per channel
+and retries the failed ones with exponential backoff. Celery beat also runs it every
+settings.NOTIFICATION_OUTBOX_DRAIN_INTERVAL seconds. A slow or failing provider so doesn't delay the caller.
+"""
+import functools
+import json
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from exponent_server_sdk import DeviceNotRegisteredError
+
+from apps.general import services
+from apps.general.decorators import run_on_commit
+from apps.general.loggers import logstash_logger
+from apps.general.models import OutboundNotification
+from apps.general.utils import in_tests
+
+QUEUED_METHODS = {
+    OutboundNotification.CHANNEL_EMAIL: ('send_email', 'send_template_batch', 'send_plain_text_email'),
+    OutboundNotification.CHANNEL_SMS: ('send_sms',),
+    OutboundNotification.CHANNEL_PUSH: ('send_push_message',),
+}
+# bulk methods are queued as one notification per message
+BULK_METHODS = {
+    OutboundNotification.CHANNEL_SMS: {'send_sms_bulk': 'send_sms'},
+    OutboundNotification.CHANNEL_PUSH: {'send_push_messages': 'send_push_message'},
+}
+# errors a retry can't fix
+PERMANENT_ERRORS = (DeviceNotRegisteredError,)
+
+
+def get_sender(channel, **factory_kwargs):
+    factory = {
+        OutboundNotification.CHANNEL_EMAIL: services.get_mandrill_mailer,
+        OutboundNotification.CHANNEL_SMS: services.get_sms_sender,
+        OutboundNotification.CHANNEL_PUSH: services.get_push_sender,
+    }[channel]
+    return factory(**factory_kwargs)
+
+
+class QueuedSender:
+    """
+    Stands in for a sender. The send methods take an optional `idempotency_key` (bulk messages may contain one)
+    and return the OutboundNotification(s); other methods, e.g. create_send_at, are the sender's own.
+    """
+    def __init__(self, channel, sender, factory_kwargs=None):
+        self.channel = channel
+        self.sender = sender
+        self.factory_kwargs = factory_kwargs or {}
+
+    def __getattr__(self, name):
+        if name in QUEUED_METHODS[self.channel]:
+            return functools.partial(self._enqueue, name)
+        if name in BULK_METHODS.get(self.channel, {}):
+            return functools.partial(self._enqueue_bulk, BULK_METHODS[self.channel][name])
+        return getattr(self.sender, name)
+
+    def _enqueue(self, method, *args, idempotency_key=None, **kwargs):
+        return enqueue_notification(self.channel, method, args, kwargs, self.factory_kwargs, idempotency_key)
+
+    def _enqueue_bulk(self, method, messages):
+        notifications = []
+        with transaction.atomic():  # one drain is dispatched, on commit
+            for message in messages:
+                message = dict(message)
+                idempotency_key = message.pop('idempotency_key', None)
+                notifications.append(
+                    enqueue_notification(self.channel, method, (), message, self.factory_kwargs, idempotency_key))
+        return notifications
+
+
+def enqueue_notification(channel, method, args=(), kwargs=None, factory_kwargs=None, idempotency_key=None):
+    """ Stores the notification unless one with the same idempotency key exists and schedules the outbox drain """
+    payload = json.dumps({'args': args, 'kwargs': kwargs or {}, 'factory_kwargs': factory_kwargs or {}},
+                         cls=DjangoJSONEncoder)
+    try:
+        with transaction.atomic():
+            notification = OutboundNotification.objects.create(
+                channel=channel, method=method, payload=payload, idempotency_key=idempotency_key,
+                next_attempt_at=timezone.now())
+    except IntegrityError:
+        if idempotency_key is None:
+            raise
+        return OutboundNotification.objects.get(idempotency_key=idempotency_key)
+    _schedule_drain()
+    return notification
+
+
+def _schedule_drain(countdown=None):
+    """
+    Hands the drain over to a worker, once per transaction. The notifications are never sent by the caller:
+    without workers they wait for the periodic drain (settings.CELERY_BEAT_SCHEDULE).
+    """
+    if countdown is None:
+        run_on_commit(_dispatch_drain, key='drain_notification_outbox')
+    else:
+        _dispatch_drain(countdown)
+
+
+def _dispatch_drain(countdown=None):
+    from apps.general.celery import workers_available
+    from apps.general.tasks import drain_notification_outbox
+    if not in_tests() and workers_available():
+        drain_notification_outbox.apply_async(countdown=countdown)
+
+
+def get_retry_delay(attempts):
+    """ Seconds before the next attempt after the given number of failed ones """
+    delay = getattr(settings, 'NOTIFICATION_OUTBOX_RETRY_DELAY', 30) * 2 ** (attempts - 1)
+    return min(delay, getattr(settings, 'NOTIFICATION_OUTBOX_MAX_RETRY_DELAY', 3600))
+
+
+def drain_outbox(batch_size=None):
+    """ Sends the due notifications, returns the number of the sent ones """
+    batch_size = batch_size or getattr(settings, 'NOTIFICATION_OUTBOX_BATCH_SIZE', 100)
+    concurrency = getattr(settings, 'NOTIFICATION_OUTBOX_CONCURRENCY', {})
+    executors = {channel: ThreadPoolExecutor(max_workers=concurrency.get(channel, 1))
+                 for channel, _ in OutboundNotification.CHANNEL_CHOICES}
+    sent = 0
+    retry_delays = []
+    try:
+        while True:
+            # the channels are sent in parallel, each by its own threads
+            futures = []
+            for channel, executor in executors.items():
+                futures.extend((n, executor.submit(_send, n)) for n in _claim(channel, batch_size))
+            if not futures:
+                break
+            for notification, future in futures:
+                retry_delay = _record_attempt(notification, future.result())
+                if retry_delay is not None:
+                    retry_delays.append(retry_delay)
+                sent += notification.status == OutboundNotification.STATUS_SENT
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+    if retry_delays:
+        _schedule_drain(countdown=min(retry_delays))
+    return sent
+
+
+def _claim(channel, limit):
+    """ Due notifications of the channel, moved into the future so that no other worker sends them meanwhile """
+    now = timezone.now()
+    lease = timedelta(seconds=getattr(settings, 'NOTIFICATION_OUTBOX_LEASE', 300))
+    with transaction.atomic():
+        notifications = list(OutboundNotification.objects.select_for_update(skip_locked=True).filter(
+            channel=channel, status=OutboundNotification.STATUS_PENDING, next_attempt_at__lte=now,
+        ).order_by('next_attempt_at')[:limit])
+        OutboundNotification.objects.filter(pk__in=[n.pk for n in notifications]).update(
+            attempts=F('attempts') + 1, next_attempt_at=now + lease)
+    for notification in notifications:
+        notification.attempts += 1
+    return notifications
+
+
+def _send(notification):
+    """ Runs in an executor thread, so it doesn't touch the database; returns the exception if sending failed """
+    payload = json.loads(notification.payload)
+    try:
+        sender = get_sender(notification.channel, **payload['factory_kwargs'])
+        getattr(sender, notification.method)(*payload['args'], **payload['kwargs'])
+    except Exception as exc:
+        return exc
+    return None
+
+
+def _record_attempt(notification, error):
+    """ Stores the outcome, returns the retry delay if the notification will be retried """
+    now = timezone.now()
+    retry_delay = None
+    if error is None:
+        notification.status = OutboundNotification.STATUS_SENT
+        notification.sent_at = now
+        notification.last_error = ''
+    else:
+        notification.last_error = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+        if isinstance(error, PERMANENT_ERRORS) or \
+                notification.attempts >= getattr(settings, 'NOTIFICATION_OUTBOX_MAX_ATTEMPTS', 6):
+            notification.status = OutboundNotification.STATUS_FAILED
+            logstash_logger.warning('Notification %s failed' % notification.pk, extra={
+                'channel': notification.channel,
+                'method': notification.method,
+                'attempts': notification.attempts,
+                'error': str(error),
+            })
+        else:
+            retry_delay = get_retry_delay(notification.attempts)
+            notification.next_attempt_at = now + timedelta(seconds=retry_delay)
+    OutboundNotification.objects.filter(pk=notification.pk).update(
+        status=notification.status, sent_at=notification.sent_at, last_error=notification.last_error,
+        next_attempt_at=notification.next_attempt_at)
+    return retry_delay
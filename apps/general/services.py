@@ -1,4 +1,9 @@
+import functools
 import pprint
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import html2text
@@ -8,31 +13,80 @@ from constance import config as dynamic_settings
 from django.conf import settings
 from django.core.mail import send_mail, get_connection, EmailMultiAlternatives
 from django.template.loader import render_to_string
+from exponent_server_sdk import DeviceNotRegisteredError
 from exponent_server_sdk import PushClient
 from exponent_server_sdk import PushMessage
 from twilio.rest import Client as TwilioClient
 
 from apps.general.loggers import sentry_logger
-from apps.general.utils import in_tests
+from apps.general.utils import in_tests, chunked
 
 
-def get_mandrill_mailer():
+@functools.lru_cache(maxsize=None)
+def get_mandrill_client(api_key):
+    """ One client, and so one pool of HTTPS connections, per process """
+    return mandrill.Mandrill(api_key)
+
+
+@functools.lru_cache(maxsize=None)
+def get_twilio_client(account, api_key):
+    """ One client, and so one pool of HTTPS connections, per process """
+    return TwilioClient(account, api_key)
+
+
+def _queued(channel, sender, factory_kwargs=None):
+    """ The sender behind the notification outbox, see `apps.general.outbox` """
+    from apps.general.outbox import QueuedSender
+    return QueuedSender(channel, sender, factory_kwargs)
+
+
+@functools.lru_cache(maxsize=64)
+def html_to_text(html_body):
+    """ html2text is slow on large bodies; mass emails usually send a few distinct bodies to many recipients """
+    return html2text.html2text(html_body)
+
+
+def get_mandrill_mailer(queued=False):
     if getattr(settings, 'MANDRILL_API_KEY', None):
-        client = mandrill.Mandrill(settings.MANDRILL_API_KEY)
-        return MandrillEmailer(client, settings.MANDRILL_SUBACCOUNT)
+        mailer = MandrillEmailer(get_mandrill_client(settings.MANDRILL_API_KEY), settings.MANDRILL_SUBACCOUNT)
     else:
-        return MandrillEmailPrinter()
+        mailer = MandrillEmailPrinter()
+    return _queued('email', mailer) if queued else mailer
 
 
-def get_sms_sender():
+def get_sms_sender(queued=False):
     if getattr(settings, 'TWILIO_ACCOUNT', None) and getattr(settings, 'TWILIO_API_KEY', None) and not in_tests():
-        return TwilioSMSSender(account=settings.TWILIO_ACCOUNT, api_key=settings.TWILIO_API_KEY)
+        sender = TwilioSMSSender(account=settings.TWILIO_ACCOUNT, api_key=settings.TWILIO_API_KEY)
     else:
-        return DevSMSSender()
+        sender = DevSMSSender()
+    return _queued('sms', sender) if queued else sender
+
+
+def get_push_sender(force_real=False, queued=False):
+    sender = DevPushSender() if not force_real and (settings.DEBUG or in_tests()) else PushSender()
+    return _queued('push', sender, {'force_real': force_real}) if queued else sender
 
 
-def get_push_sender(force_real=False):
-    return DevPushSender() if not force_real and (settings.DEBUG or in_tests()) else PushSender()
+# Outcome of one message of a bulk send; `error` is the exception if it failed, so the message can be retried
+SendResult = namedtuple('SendResult', 'message result error')
+# SendResults of a push batch and the tokens Expo reported as DeviceNotRegistered, which should be forgotten
+PushBatchResult = namedtuple('PushBatchResult', 'results unregistered_tokens')
+
+
+class RateLimiter:
+    """ Spaces the calls of `wait` evenly so that at most `per_second` of them pass per second, thread-safe """
+    def __init__(self, per_second):
+        self._interval = 1.0 / per_second if per_second else 0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
 
 
 class TwilioSMSSender:
@@ -40,9 +94,32 @@ class TwilioSMSSender:
         self._account = account
         self._api_key = api_key
 
+    @property
+    def client(self):
+        return get_twilio_client(self._account, self._api_key)
+
     def send_sms(self, to, from_phone, text, messaging_service_sid=None):
-        client = TwilioClient(self._account, self._api_key)
-        return client.messages.create(to=to, from_=from_phone, body=text, messaging_service_sid=messaging_service_sid)
+        return self.client.messages.create(
+            to=to, from_=from_phone, body=text, messaging_service_sid=messaging_service_sid)
+
+    def send_sms_bulk(self, messages):
+        """
+        Sends the messages (dicts of `send_sms` kwargs) concurrently by settings.TWILIO_BULK_WORKERS threads,
+        at most settings.TWILIO_MESSAGES_PER_SECOND per second. Returns a SendResult per message, in order.
+        """
+        rate_limiter = RateLimiter(getattr(settings, 'TWILIO_MESSAGES_PER_SECOND', 10))
+
+        def send(message):
+            rate_limiter.wait()
+            try:
+                return SendResult(message, self.send_sms(**message), None)
+            except Exception as exc:
+                return SendResult(message, None, exc)
+
+        if not messages:
+            return []
+        with ThreadPoolExecutor(max_workers=getattr(settings, 'TWILIO_BULK_WORKERS', 4)) as executor:
+            return list(executor.map(send, messages))
 
 
 class DevSMSSender:
@@ -52,6 +129,9 @@ class DevSMSSender:
             pprint.pprint(locals())
         return True
 
+    def send_sms_bulk(self, messages):
+        return [SendResult(message, self.send_sms(**message), None) for message in messages]
+
 
 class PushSender:
     def send_push_message(self, token, message, extra=None, priority='high'):
@@ -85,6 +165,56 @@ class PushSender:
                 })
             raise
 
+    def send_push_messages(self, messages):
+        """
+        Sends the messages (dicts of `send_push_message` kwargs) with one Expo request per
+        settings.EXPO_PUSH_BATCH_SIZE of them and validates every ticket. Errors are reported to Sentry once per batch.
+        """
+        results = []
+        batch_size = getattr(settings, 'EXPO_PUSH_BATCH_SIZE', 100)
+        for start in range(0, len(messages), batch_size):
+            results.extend(self._send_push_batch(messages[start:start + batch_size]))
+        return PushBatchResult(results, [
+            r.message['token'] for r in results if isinstance(r.error, DeviceNotRegisteredError)])
+
+    def _send_push_batch(self, messages):
+        push_messages = [
+            PushMessage(to=m['token'], body=m['message'], data=m.get('extra'), priority=m.get('priority', 'high'))
+            for m in messages
+        ]
+        try:
+            responses = PushClient().publish_multiple(push_messages)
+        except Exception as exc:
+            # The whole request failed, e.g. a formatting/validation error of one of the messages.
+            if getattr(settings, 'DJANGO_SENTRY_URL', None):
+                sentry_logger.exception('PushServerError: %s' % exc, exc_info=exc, extra={
+                    'tokens': [m['token'] for m in messages],
+                    'errors': getattr(exc, 'errors', None),
+                    'response_data': getattr(exc, 'response_data', None),
+                })
+            return [SendResult(message, None, exc) for message in messages]
+
+        results = []
+        for message, response in zip(messages, responses):
+            try:
+                response.validate_response()
+                results.append(SendResult(message, response, None))
+            except Exception as exc:
+                results.append(SendResult(message, getattr(exc, 'push_response', None), exc))
+
+        errors = [r for r in results if r.error is not None]
+        if errors and getattr(settings, 'DJANGO_SENTRY_URL', None):
+            summary = 'PushResponseErrors: %s of %s push messages failed' % (len(errors), len(results))
+            sentry_logger.error(summary, extra={
+                'errors': [{
+                    'token': r.message['token'],
+                    'push_message': r.message['message'],
+                    'error': '%s: %s' % (type(r.error).__name__, r.error),
+                    'push_response': r.result._asdict() if r.result else None,
+                } for r in errors],
+            })
+        return results
+
 
 class DevPushSender:
     def send_push_message(self, token, message, extra=None):
@@ -93,6 +223,12 @@ class DevPushSender:
             pprint.pprint(locals())
         return True
 
+    def send_push_messages(self, messages):
+        results = [
+            SendResult(m, self.send_push_message(m['token'], m['message'], m.get('extra')), None) for m in messages
+        ]
+        return PushBatchResult(results, [])
+
 
 class BaseEmailer:
     def wrap_html(self, html_body, request):
@@ -132,27 +268,52 @@ class BaseEmailer:
             message['from_name'] = from_name
         return message
 
+    def _create_mandrill_batch_messages(self, from_email, recipients, subject=None):
+        """
+        Messages with up to settings.MANDRILL_BATCH_SIZE recipients each, every recipient gets own variables
+        and doesn't see the others.
+        :param list recipients: The list of tuples with structure (to, variables).
+        """
+        batch_size = getattr(settings, 'MANDRILL_BATCH_SIZE', 1000)
+        for start in range(0, len(recipients), batch_size):
+            batch = recipients[start:start + batch_size]
+            message = self._create_mandrill_message(from_email, batch[0][0], batch[0][1], subject)
+            message['to'] = [{'email': to, 'type': 'to'} for to, _ in batch]
+            message['merge_vars'] = [{'rcpt': to, 'vars': variables} for to, variables in batch]
+            message['preserve_recipients'] = False
+            yield message
+
 
 class Emailer(BaseEmailer):
     def send_email(self, subject, html_body, to):
-        send_mail(subject, html2text.html2text(html_body), settings.DEFAULT_FROM_EMAIL, [to], html_message=html_body)
+        send_mail(subject, html_to_text(html_body), settings.DEFAULT_FROM_EMAIL, [to], html_message=html_body)
 
-    def send_mass_email(self, data):
+    def send_mass_email(self, data, wrap=False):
         """
         Send several emails using the same connection in the text and html format.
         Use settings.DEFAULT_FROM_EMAIL as sender email.
+        The messages are built and sent per settings.EMAIL_MASS_CHUNK_SIZE, so `data` may be a generator
+        and the memory doesn't grow with the number of recipients.
 
-        :param list data: The list of tuples with structure (subject, html_body, to).
+        :param iterable data: The tuples with structure (subject, html_body, to).
+        :param bool wrap: Whether to wrap the bodies in general/email.html, rendered once per distinct body.
         :return: Number of emails sent.
         """
+        wrap_html = functools.lru_cache(maxsize=16)(lambda html_body: self.wrap_html(html_body, None))
         connection = get_connection()
-        messages = [self._make_email(connection, *x) for x in data]
-        result = connection.send_messages(messages)
-        connection.close()
+        connection.open()  # else the connection would be reopened per chunk
+        result = 0
+        try:
+            for chunk in chunked(data, getattr(settings, 'EMAIL_MASS_CHUNK_SIZE', 100)):
+                messages = [self._make_email(connection, subject, wrap_html(html_body) if wrap else html_body, to)
+                            for subject, html_body, to in chunk]
+                result += connection.send_messages(messages) or 0
+        finally:
+            connection.close()
         return result
 
     def _make_email(self, connection, subject, html_body, to):
-        email = EmailMultiAlternatives(subject, html2text.html2text(html_body), settings.DEFAULT_FROM_EMAIL, [to],
+        email = EmailMultiAlternatives(subject, html_to_text(html_body), settings.DEFAULT_FROM_EMAIL, [to],
                                        connection=connection)
         email.attach_alternative(html_body, 'text/html')
         return email
@@ -168,6 +329,19 @@ class MandrillEmailer(BaseEmailer):
         self.client.messages.send_template(
             template_name, template_content='', message=message, async=True, send_at=send_at)
 
+    def send_template_batch(self, from_email, recipients, template_name, send_at=None, subject=None):
+        """
+        Sends the template to many recipients with one API call per settings.MANDRILL_BATCH_SIZE of them.
+
+        :param list recipients: The list of tuples with structure (to, variables).
+        :return: Mandrill's per recipient results.
+        """
+        results = []
+        for message in self._create_mandrill_batch_messages(from_email, recipients, subject):
+            results.extend(self.client.messages.send_template(
+                template_name, template_content='', message=message, async=True, send_at=send_at))
+        return results
+
     def send_plain_text_email(self, from_email, to, subject, text, send_at=None):
         message = self._create_mandrill_message(from_email, to, {}, subject)
         message['text'] = text
@@ -197,6 +371,12 @@ class MandrillEmailPrinter(BaseEmailer):
         if not getattr(settings, 'SUPPRESS_DEBUG_EMAILS', None):
             pprint.pprint(message)
 
+    def send_template_batch(self, from_email, recipients, template_name, send_at=None, subject=None):
+        for message in self._create_mandrill_batch_messages(from_email, recipients, subject):
+            if not getattr(settings, 'SUPPRESS_DEBUG_EMAILS', None):
+                pprint.pprint(message)
+        return [{'email': to, 'status': 'printed'} for to, _ in recipients]
+
     def send_plain_text_email(self, from_email, to, subject, text, send_at=None):
         message = self._create_mandrill_message(from_email, to, {}, subject)
         message['text'] = text
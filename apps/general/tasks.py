@@ -0,0 +1,9 @@
+from celery import shared_task
+
+from apps.general.outbox import drain_outbox
+
+
+@shared_task(ignore_result=True)
+def drain_notification_outbox():
+    """ Sends the due notifications of the outbox; enqueueing schedules it, celery beat can run it as a safety net """
+    return drain_outbox()
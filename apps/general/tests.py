@@ -1,25 +1,53 @@
 import datetime
-from unittest.mock import patch, call, ANY
+import json
+import tempfile
+import threading
+import time
+from unittest.mock import patch, call, ANY, Mock
 
 import graphene
+import graphql
 from celery import current_app
+from constance import config
 from django.conf import settings
-from django.db import transaction
-from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from django_celery_beat.models import PeriodicTask
+from django_celery_results.models import TaskResult
 from graphene.test import Client
 from graphene.utils.resolve_only_args import resolve_only_args
 import pytz
 from dateutil.parser import parse as parse_datetime
 from model_mommy import mommy
+from promise import Promise
 
 from apps.appointments.event.models import Event
 from apps.appointments.models import Appointment
-from apps.general.exceptions import InvalidParamException, ErrorDto, InternalErrorException
-from apps.general.graphql import format_error
-from apps.general.services import BaseEmailer
+from apps.general.celery import (
+    WMCPDatabaseBackend, prune_task_results, get_task_registry, task_actions, workers_available, get_task_metrics,
+    record_task_start, record_task_end, record_task_retry, TASK_METRICS_PREFIX, store_worker_heartbeat,
+    WORKER_HEARTBEAT_CACHE_KEY, WORKERS_AVAILABLE_CACHE_KEY, run_task,
+)
+from apps.general.decorators import run_on_commit
+from apps.general.exceptions import InvalidParamException, ErrorDto, InternalErrorException, \
+    QueryTooComplexException
+from apps.general.graphql import (
+    format_error, GraphQLView, hash_query, get_document_cache, BatchExecutor, DataLoaders, QueryCostAnalyzer,
+    ResolverTimingMiddleware, invalidate_cached_responses, get_response_cache_models, PersistedQueryRegistry,
+    get_graphql_cache,
+)
+from apps.general.metrics import metrics, MetricsRegistry, get_published_metrics
+from apps.general.outbox import get_retry_delay, drain_outbox
+from apps.general.models import TaskResultName, OutboundNotification
+from apps.general.services import (
+    BaseEmailer, MandrillEmailer, get_mandrill_mailer, TwilioSMSSender, RateLimiter, get_twilio_client, PushSender,
+    get_sms_sender, get_push_sender, Emailer, html_to_text,
+)
 from apps.resident.models import Resident
-from apps.general.utils import DateUtils, nth_item
+from apps.general.utils import DateUtils, nth_item, iter_csv, csv_value_from_dict
 
 
 class GraphQLTests(SimpleTestCase):
@@ -98,6 +126,273 @@ class GraphQLTests(SimpleTestCase):
         )
 
 
+class PersistedQueryTests(SimpleTestCase):
+    class TestQuery(graphene.ObjectType):
+        hello = graphene.String()
+
+        @resolve_only_args
+        def resolve_hello(self):
+            return 'world'
+
+    test_schema = graphene.Schema(query=TestQuery)
+    query = 'query { hello }'
+
+    def setUp(self):
+        get_document_cache().clear()
+
+    def _post(self, data):
+        request = RequestFactory().post('/graphql', json.dumps(data), content_type='application/json')
+        view = GraphQLView.as_view(schema=self.test_schema)
+        return json.loads(view(request).content.decode())
+
+    def _extensions(self, query_hash):
+        return {'persistedQuery': {'version': 1, 'sha256Hash': query_hash}}
+
+    def test_unknown_hash_returns_not_found(self):
+        result = self._post({'extensions': self._extensions('0' * 64)})
+        self.assertEqual(result['errors'][0]['message'], 'PersistedQueryNotFound')
+        self.assertEqual(result['errors'][0]['code'], 'persisted_query_not_found')
+
+    @patch('apps.general.graphql.parse', side_effect=graphql.parse)
+    def test_registered_query_is_served_by_hash_without_parsing(self, mock_parse):
+        query_hash = hash_query(self.query)
+        result = self._post({'query': self.query, 'extensions': self._extensions(query_hash)})
+        self.assertEqual(result['data'], {'hello': 'world'})
+        result = self._post({'extensions': self._extensions(query_hash)})
+        self.assertEqual(result['data'], {'hello': 'world'})
+        self.assertEqual(mock_parse.call_count, 1)
+
+    def test_hash_mismatch_is_rejected(self):
+        result = self._post({'query': self.query, 'extensions': self._extensions('0' * 64)})
+        self.assertEqual(result['errors'][0]['code'], InvalidParamException.code)
+
+    def test_manifest_disables_registration(self):
+        query_hash = hash_query(self.query)
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as manifest:
+            json.dump({query_hash: self.query}, manifest)
+            manifest.flush()
+            registry = PersistedQueryRegistry(manifest.name)
+        registry.register(hash_query('query { other }'), 'query { other }')
+        self.assertEqual(registry.get(query_hash), self.query)
+        self.assertIsNone(registry.get(hash_query('query { other }')))
+        self.assertIsNone(get_graphql_cache().get(PersistedQueryRegistry.cache_key % hash_query('query { other }')))
+
+
+class QueryCostTests(SimpleTestCase):
+    class Item(graphene.ObjectType):
+        name = graphene.String()
+        children = graphene.List(lambda: QueryCostTests.Item, first=graphene.Int())
+
+    class TestQuery(graphene.ObjectType):
+        items = graphene.List(lambda: QueryCostTests.Item, first=graphene.Int())
+
+    test_schema = graphene.Schema(query=TestQuery)
+
+    def _analyze(self, query, variables=None):
+        return QueryCostAnalyzer(self.test_schema, graphql.parse(query), variables).analyze()
+
+    @override_settings(GRAPHQL_LIST_MULTIPLIER=10, GRAPHQL_DEFAULT_FIELD_COST=1, GRAPHQL_FIELD_COSTS={})
+    def test_multiplies_nested_lists(self):
+        self.assertEqual(self._analyze('{ items { name } }'), (1 + 10 * 1, 2))
+        self.assertEqual(self._analyze('{ items(first: 2) { name children { name } } }'), (1 + 2 * (1 + 1 + 10), 3))
+        self.assertEqual(self._analyze('query q($n: Int) { items(first: $n) { ...f } } fragment f on Item { name }',
+                                       {'n': 3}), (1 + 3, 2))
+
+    @override_settings(GRAPHQL_FIELD_COSTS={'Item.name': 5})
+    def test_uses_configured_field_costs(self):
+        self.assertEqual(self._analyze('{ items(first: 1) { name } }').cost, 1 + 5)
+
+    @override_settings(GRAPHQL_MAX_QUERY_DEPTH=2, GRAPHQL_ENFORCE_QUERY_COST=True)
+    def test_rejects_too_deep_query(self):
+        request = RequestFactory().post(
+            '/graphql', json.dumps({'query': '{ items { children { name } } }'}), content_type='application/json')
+        response = GraphQLView.as_view(schema=self.test_schema)(request)
+        error = json.loads(response.content.decode())['errors'][0]
+        self.assertEqual(error['code'], QueryTooComplexException.code)
+        self.assertEqual(error['errors'][0]['key'], 'depth')
+        self.assertEqual(response['X-GraphQL-Cost'], str(1 + 10 * (1 + 10)))
+
+    @override_settings(GRAPHQL_ENFORCE_QUERY_COST=True, GRAPHQL_MAX_QUERY_DEPTH=12, GRAPHQL_MAX_QUERY_COST=20000)
+    def test_introspection_is_free(self):
+        from graphql.utils.introspection_query import introspection_query
+        self.assertEqual(self._analyze(introspection_query), (0, 0))
+        self.assertEqual(self._analyze('{ __typename items(first: 1) { __typename name } }'), (1 + 1, 2))
+
+        request = RequestFactory().post(
+            '/graphql', json.dumps({'query': introspection_query}), content_type='application/json')
+        result = json.loads(GraphQLView.as_view(schema=self.test_schema)(request).content.decode())
+        self.assertNotIn('errors', result)
+        self.assertIn('__schema', result['data'])
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_metrics_of_other_processes_are_published(self):
+        other_process = MetricsRegistry()
+        with patch('apps.general.metrics.os.getpid', return_value=-1):
+            other_process.increment('test.counter', 3)  # the first metric is published at once
+
+        snapshots = get_published_metrics('test.')
+        other = [snapshot for snapshot in snapshots if snapshot['process'].endswith(':-1')]
+        self.assertEqual(len(other), 1)
+        self.assertEqual(other[0]['counters'], {'test.counter': 3})
+
+
+class ResolverTimingMiddlewareTests(SimpleTestCase):
+    class TestQuery(graphene.ObjectType):
+        hello = graphene.String()
+
+        @resolve_only_args
+        def resolve_hello(self):
+            return 'world'
+
+    test_schema = graphene.Schema(query=TestQuery)
+
+    def setUp(self):
+        metrics.reset('graphql.resolver.')
+
+    @override_settings(GRAPHQL_RESOLVER_TIMING_SAMPLE_RATE=1, GRAPHQL_SLOW_RESOLVER_MS=0)
+    @patch('apps.general.graphql.logstash_logger')
+    def test_records_resolver_timings(self, mock_logstash_logger):
+        result = self.test_schema.execute('{ hello }', middleware=[ResolverTimingMiddleware()])
+        self.assertEqual(result.data, {'hello': 'world'})
+        histograms = metrics.snapshot('graphql.resolver.')['histograms']
+        self.assertEqual(histograms['graphql.resolver.TestQuery.hello.time_ms']['count'], 1)
+        self.assertEqual(histograms['graphql.resolver.TestQuery.hello.db_queries']['sum'], 0)
+        mock_logstash_logger.warning.assert_called_once_with('Slow GraphQL resolver TestQuery.hello', extra=ANY)
+
+    @override_settings(GRAPHQL_RESOLVER_TIMING_SAMPLE_RATE=0)
+    def test_skips_unsampled_requests(self):
+        self.test_schema.execute('{ hello }', middleware=[ResolverTimingMiddleware()])
+        self.assertEqual(metrics.snapshot('graphql.resolver.')['histograms'], {})
+
+
+@override_settings(GRAPHQL_RESPONSE_CACHE_FIELDS={
+    'counter': {'timeout': 60, 'models': ['auth.Group']},
+    'invalidating': {'timeout': 60, 'models': ['auth.Group']},
+})
+class ResponseCacheTests(SimpleTestCase):
+    calls = 0
+
+    class TestQuery(graphene.ObjectType):
+        counter = graphene.Int()
+        invalidating = graphene.Int()
+        uncached = graphene.Int()
+
+        @resolve_only_args
+        def resolve_counter(self):
+            ResponseCacheTests.calls += 1
+            return ResponseCacheTests.calls
+
+        @resolve_only_args
+        def resolve_invalidating(self):
+            ResponseCacheTests.calls += 1
+            invalidate_cached_responses(sender=Group)  # e.g. a concurrent save
+            return ResponseCacheTests.calls
+
+        @resolve_only_args
+        def resolve_uncached(self):
+            return 0
+
+    test_schema = graphene.Schema(query=TestQuery)
+
+    def setUp(self):
+        ResponseCacheTests.calls = 0
+
+    def _post(self, query):
+        request = RequestFactory().post('/graphql', json.dumps({'query': query}), content_type='application/json')
+        return json.loads(GraphQLView.as_view(schema=self.test_schema)(request).content.decode())['data']
+
+    def test_caches_until_model_changes(self):
+        self.assertEqual(self._post('{ counter }'), {'counter': 1})
+        self.assertEqual(self._post('query {\n  counter\n}'), {'counter': 1})
+        invalidate_cached_responses(sender=Group)
+        self.assertEqual(self._post('{ counter }'), {'counter': 2})
+
+    def test_invalidation_during_execution_is_not_lost(self):
+        self.assertEqual(self._post('{ invalidating }'), {'invalidating': 1})
+        self.assertEqual(self._post('{ invalidating }'), {'invalidating': 2})
+
+    def test_only_declared_models_invalidate(self):
+        self.assertEqual(get_response_cache_models(), {Group})
+
+    def test_does_not_cache_queries_with_uncacheable_fields(self):
+        self._post('{ counter uncached }')
+        self.assertEqual(self._post('{ counter uncached }'), {'counter': 2, 'uncached': 0})
+
+
+class BatchExecutorTests(SimpleTestCase):
+    def test_returns_results_in_order(self):
+        executor = BatchExecutor(max_workers=4, max_concurrency=2, deadline=5)
+        futures = executor.map(lambda x: time.sleep(0.01 * (5 - x)) or x * 2, list(range(5)))
+        self.assertEqual([f.result() for f in futures], [0, 2, 4, 6, 8])
+
+    def test_unfinished_operations_are_dropped_after_deadline(self):
+        executor = BatchExecutor(max_workers=2, max_concurrency=2, deadline=0.1)
+        futures = executor.map(lambda x: time.sleep(x) or x, [0, 1, 0])
+        self.assertEqual(futures[0].result(), 0)
+        self.assertIsNone(futures[1])
+        self.assertEqual(futures[2].result(), 0)
+
+
+class BatchedGraphQLViewTests(SimpleTestCase):
+    class TestQuery(graphene.ObjectType):
+        thread = graphene.String()
+        failing = graphene.String()
+
+        @resolve_only_args
+        def resolve_thread(self):
+            return threading.current_thread().name
+
+        @resolve_only_args
+        def resolve_failing(self):
+            raise InternalErrorException(detail='App internal error.')
+
+    test_schema = graphene.Schema(query=TestQuery)
+
+    @override_settings(GRAPHQL_BATCH_WORKERS=2, GRAPHQL_BATCH_CONCURRENCY=2)
+    @patch('apps.general.graphql._batch_executor', None)
+    @patch('apps.general.graphql.in_tests', return_value=False)
+    @patch('apps.general.loggers.django_logger')
+    def test_batch_runs_concurrently_in_order(self, mock_django_logger, mock_in_tests):
+        data = [{'id': i, 'query': '{ failing }' if i == 1 else '{ thread }'} for i in range(4)]
+        request = RequestFactory().post('/graphql', json.dumps(data), content_type='application/json')
+        response = GraphQLView.as_view(schema=self.test_schema, batch=True)(request)
+        results = json.loads(response.content.decode())
+
+        self.assertEqual([result['id'] for result in results], [0, 1, 2, 3])
+        self.assertEqual(results[1]['errors'][0]['message'], 'App internal error.')
+        for result in (results[0], results[2], results[3]):
+            self.assertNotIn('errors', result)
+            self.assertNotEqual(result['data']['thread'], threading.current_thread().name)
+
+
+class DataLoadersTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.groups = [Group.objects.create(name='group%s' % i) for i in range(3)]
+
+    def test_coalesces_lookups_into_one_query(self):
+        loaders = DataLoaders()
+        with self.assertNumQueries(1):
+            promise = Promise.all([loaders.for_model(Group).load(group.pk) for group in self.groups] +
+                                  [loaders.for_model(Group).load(str(self.groups[0].pk))])
+            self.assertEqual(promise.get(), self.groups + [self.groups[0]])
+
+    def test_caches_within_request(self):
+        loaders = DataLoaders()
+        loaders.for_model(Group).load(self.groups[0].pk).get()
+        with self.assertNumQueries(0):
+            self.assertEqual(loaders.for_model(Group).load(self.groups[0].pk).get(), self.groups[0])
+
+    def test_loads_many_by_field(self):
+        loaders = DataLoaders()
+        promise = loaders.for_model(Group, field='name', many=True).load_many(['group1', 'missing'])
+        self.assertEqual(promise.get(), [[self.groups[1]], []])
+
+
 class BaseEmailerTests(SimpleTestCase):
     def test_split_email_and_name(self):
         email1 = 'john@smith.com'
@@ -112,6 +407,159 @@ class BaseEmailerTests(SimpleTestCase):
             ('John', 'john.smith+something@gmail.com'))
 
 
+class MandrillEmailerTests(SimpleTestCase):
+    @override_settings(MANDRILL_BATCH_SIZE=2)
+    def test_send_template_batch(self):
+        client = Mock()
+        client.messages.send_template.side_effect = lambda *args, **kwargs: [
+            {'email': r['email'], 'status': 'queued'} for r in kwargs['message']['to']]
+        emailer = MandrillEmailer(client, 'sub')
+        recipients = [('a@a.com', [{'name': 'n', 'content': 1}]), ('b@b.com', []), ('c@c.com', [])]
+
+        results = emailer.send_template_batch('from@a.com', recipients, 'template')
+
+        self.assertEqual([r['email'] for r in results], ['a@a.com', 'b@b.com', 'c@c.com'])
+        self.assertEqual(client.messages.send_template.call_count, 2)
+        message = client.messages.send_template.call_args_list[0][1]['message']
+        self.assertFalse(message['preserve_recipients'])
+        self.assertEqual(message['merge_vars'][0], {'rcpt': 'a@a.com', 'vars': [{'name': 'n', 'content': 1}]})
+
+    @override_settings(MANDRILL_API_KEY='key', MANDRILL_SUBACCOUNT='sub')
+    def test_client_is_shared(self):
+        self.assertIs(get_mandrill_mailer().client, get_mandrill_mailer().client)
+
+
+class EmailerTests(SimpleTestCase):
+    @override_settings(EMAIL_MASS_CHUNK_SIZE=2, EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_send_mass_email_converts_each_body_once(self):
+        from django.core import mail
+        html_to_text.cache_clear()
+        data = (('Subject', '<p>Digest</p>', 'user%s@a.com' % i) for i in range(5))
+
+        with patch('apps.general.services.html2text.html2text', return_value='Digest') as convert:
+            sent = Emailer().send_mass_email(data, wrap=True)
+
+        self.assertEqual(sent, 5)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(convert.call_count, 1)
+        self.assertIn('emailContainer', mail.outbox[0].alternatives[0][0])
+        self.assertEqual(mail.outbox[4].to, ['user4@a.com'])
+        html_to_text.cache_clear()
+
+
+class TwilioSMSSenderTests(SimpleTestCase):
+    def test_send_sms_bulk_returns_result_per_message(self):
+        def create(to, **kwargs):
+            if to == '2':
+                raise ValueError('Invalid number')
+            return 'sid-%s' % to
+
+        client = Mock()
+        client.messages.create.side_effect = create
+        messages = [{'to': str(i), 'from_phone': '+1', 'text': 'hi'} for i in range(4)]
+
+        with patch('apps.general.services.get_twilio_client', return_value=client):
+            results = TwilioSMSSender('account', 'key').send_sms_bulk(messages)
+
+        self.assertEqual([r.message for r in results], messages)
+        self.assertEqual([r.result for r in results], ['sid-0', 'sid-1', None, 'sid-3'])
+        self.assertIsInstance(results[2].error, ValueError)
+        self.assertEqual(client.messages.create.call_count, 4)
+
+    def test_client_is_shared(self):
+        with patch('apps.general.services.TwilioClient'):
+            get_twilio_client.cache_clear()
+            self.assertIs(TwilioSMSSender('account', 'key').client, TwilioSMSSender('account', 'key').client)
+        get_twilio_client.cache_clear()
+
+    def test_rate_limiter(self):
+        rate_limiter = RateLimiter(per_second=100)
+        start = time.monotonic()
+        for _ in range(6):
+            rate_limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+
+class PushSenderTests(SimpleTestCase):
+    @override_settings(EXPO_PUSH_BATCH_SIZE=2, DJANGO_SENTRY_URL='http://sentry')
+    def test_send_push_messages_in_batches(self):
+        from exponent_server_sdk import DeviceNotRegisteredError
+
+        def response(push_message):
+            result = Mock(push_message=push_message)
+            if push_message.to == 'gone':
+                result.validate_response.side_effect = DeviceNotRegisteredError(result)
+            return result
+
+        messages = [{'token': token, 'message': 'hi'} for token in ('a', 'gone', 'b')]
+        with patch('apps.general.services.PushClient') as push_client, \
+                patch('apps.general.services.sentry_logger') as sentry_logger:
+            push_client.return_value.publish_multiple.side_effect = lambda push_messages: [
+                response(m) for m in push_messages]
+            batch = PushSender().send_push_messages(messages)
+
+        self.assertEqual(push_client.return_value.publish_multiple.call_count, 2)
+        self.assertEqual([r.message for r in batch.results], messages)
+        self.assertEqual([r.error is None for r in batch.results], [True, False, True])
+        self.assertEqual(batch.unregistered_tokens, ['gone'])
+        self.assertEqual(sentry_logger.error.call_count, 1)
+
+
+class NotificationOutboxTests(TestCase):
+    @patch('apps.general.services.DevSMSSender.send_sms')
+    def test_queued_sms_is_sent_once_per_idempotency_key(self, send_sms):
+        sender = get_sms_sender(queued=True)
+        notification = sender.send_sms(to='+1', from_phone='+2', text='hi', idempotency_key='reminder-1')
+        sender.send_sms(to='+1', from_phone='+2', text='hi', idempotency_key='reminder-1')
+        send_sms.assert_not_called()  # never sent by the caller
+
+        self.assertEqual(drain_outbox(), 1)
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, OutboundNotification.STATUS_SENT)
+        self.assertEqual(notification.attempts, 1)
+        self.assertEqual(OutboundNotification.objects.count(), 1)
+        send_sms.assert_called_once_with(to='+1', from_phone='+2', text='hi')
+
+    @patch('apps.general.services.DevSMSSender.send_sms', side_effect=Exception('Provider is down'))
+    def test_failed_notification_is_retried_with_backoff(self, send_sms):
+        notification = get_sms_sender(queued=True).send_sms(to='+1', from_phone='+2', text='hi')
+        drain_outbox()
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, OutboundNotification.STATUS_PENDING)
+        self.assertIn('Provider is down', notification.last_error)
+        self.assertAlmostEqual((notification.next_attempt_at - DateUtils.utc_now()).total_seconds(), 30, delta=5)
+
+        get_sms_sender(queued=True).send_sms(to='+1', from_phone='+2', text='hi again')
+        with override_settings(NOTIFICATION_OUTBOX_MAX_ATTEMPTS=1):
+            drain_outbox()
+        self.assertEqual(OutboundNotification.objects.filter(status=OutboundNotification.STATUS_FAILED).count(), 1)
+
+    def test_retry_delay(self):
+        self.assertEqual([get_retry_delay(attempts) for attempts in (1, 2, 3, 20)], [30, 60, 120, 3600])
+
+    @patch('apps.general.outbox.in_tests', return_value=False)
+    @patch('apps.general.celery.workers_available', return_value=True)
+    @patch('apps.general.tasks.drain_notification_outbox')
+    @patch('apps.general.services.DevPushSender.send_push_message')
+    def test_bulk_push_is_queued_per_message(self, send_push_message, drain_task, mock_workers_available,
+                                             mock_in_tests):
+        messages = [{'token': 'a', 'message': 'hi'}, {'token': 'b', 'message': 'hi', 'idempotency_key': 'b'}]
+        with patch('apps.general.decorators.in_tests', return_value=False):
+            notifications = get_push_sender(queued=True).send_push_messages(messages)
+
+        self.assertEqual(len(notifications), 2)
+        self.assertEqual(OutboundNotification.objects.get(idempotency_key='b').method, 'send_push_message')
+        send_push_message.assert_not_called()
+        # the test transaction isn't committed, so the one coalesced drain is still waiting for it
+        self.assertEqual(len([f for _, f in transaction.get_connection().run_on_commit
+                              if getattr(f, 'coalesce_key', None) == 'drain_notification_outbox']), 1)
+        drain_task.apply_async.assert_not_called()
+
+        self.assertEqual(drain_outbox(), 2)
+        self.assertEqual(send_push_message.call_count, 2)
+
+
 class IterUtilsTests(SimpleTestCase):
     def test_returns_nth_element_of_iterator(self):
         items = [2, 4, 6, 8, 12]
@@ -120,6 +568,36 @@ class IterUtilsTests(SimpleTestCase):
         self.assertEqual(nth_item(iter(items), 5), None)
 
 
+class CsvExportTests(TestCase):
+    def test_iter_csv_yields_chunks(self):
+        rows = ({'name': 'n%s' % i, 'count': i} for i in range(5))
+        chunks = list(iter_csv(['name', 'count'], rows, chunk_size=2))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(b''.join(chunks).decode(), 'name,count\r\nn0,0\r\nn1,1\r\nn2,2\r\nn3,3\r\nn4,4\r\n')
+        self.assertEqual(list(iter_csv(['name'], [])), [b'name\r\n'])
+
+    def test_iter_csv_reads_querysets_in_chunks(self):
+        Group.objects.bulk_create([Group(name='group %s' % i) for i in range(3)])
+        content = b''.join(iter_csv(['name'], Group.objects.order_by('name').values_list('name'), chunk_size=2))
+        self.assertEqual(content.decode(), 'name\r\ngroup 0\r\ngroup 1\r\ngroup 2\r\n')
+
+    def test_iter_csv_reads_model_querysets_as_values_list(self):
+        Group.objects.bulk_create([Group(name='group %s' % i) for i in range(2)])
+        content = b''.join(iter_csv(['name'], Group.objects.order_by('name'), chunk_size=1))
+        self.assertEqual(content.decode(), 'name\r\ngroup 0\r\ngroup 1\r\n')
+
+    def test_iter_csv_writes_flat_values_as_one_column(self):
+        Group.objects.bulk_create([Group(name='group %s' % i) for i in range(2)])
+        rows = Group.objects.order_by('name').values_list('name', flat=True)
+        self.assertEqual(b''.join(iter_csv(['name'], rows)).decode(), 'name\r\ngroup 0\r\ngroup 1\r\n')
+        with self.assertRaises(TypeError):
+            list(iter_csv(['name', 'id'], rows))
+
+    def test_csv_value_from_dict(self):
+        self.assertEqual(csv_value_from_dict(['a', 'b'], [{'a': 1}]), 'a,b\r\n1,\r\n')
+
+
 class GeneralTest(TestCase):
 
     def setUp(self):
@@ -203,6 +681,33 @@ class GeneralTransactionalTests(TransactionTestCase):
                     mommy.make(Event)
                 self.assertFalse(mock_send_booking_updated.run.called)
 
+    @patch('apps.general.decorators.in_tests', return_value=False)
+    def test_run_on_commit_coalesces_calls_with_the_same_key(self, mock_in_tests):
+        callback = Mock()
+        with transaction.atomic():
+            run_on_commit(lambda: callback('a'), key='a')
+            run_on_commit(lambda: callback('a'), key='a')
+            try:
+                with transaction.atomic():
+                    run_on_commit(lambda: callback('b'), key='b')
+                    raise ValueError
+            except ValueError:
+                pass
+            run_on_commit(lambda: callback('b'), key='b')
+            self.assertFalse(callback.called)
+        self.assertEqual(callback.call_args_list, [call('a'), call('b')])
+
+    @patch('apps.general.decorators.in_tests', return_value=False)
+    def test_run_task_coalesces_only_on_request(self, mock_in_tests):
+        task = Mock()
+        task.name = 'apps.general.tasks.some_task'
+        with transaction.atomic():
+            run_task(task, 1)
+            run_task(task, 1)
+            run_task(task, 2, coalesce=True)
+            run_task(task, 2, coalesce=True)
+        self.assertEqual(task.run.call_args_list, [call(1), call(1), call(2)])
+
 
 class TestCeleryTasks(TestCase):
     def setUp(self):
@@ -245,6 +750,120 @@ class TestCeleryTasks(TestCase):
             )
 
 
+class TaskRegistryTests(SimpleTestCase):
+    def test_run_action_is_shown_for_registered_tasks_only(self):
+        self.assertIn('celery.backend_cleanup', get_task_registry())
+        # SimpleTestCase fails on any database query
+        self.assertIn('Run', task_actions(None, PeriodicTask(id=1, task='celery.backend_cleanup')))
+        self.assertEqual(task_actions(None, PeriodicTask(id=2, task='apps.general.tasks.unknown')), '')
+
+
+class TaskMetricsTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset(TASK_METRICS_PREFIX)
+        self.task = Mock(request=Mock(published_at=time.time() - 2))
+        self.task.name = 'apps.general.tasks.some_task'
+
+    @override_settings(CELERY_SLOW_TASK_MS=0)
+    @patch('apps.general.celery.logstash_logger')
+    def test_records_runtime_queue_wait_and_outcome(self, mock_logstash_logger):
+        record_task_start(task_id='task-1', task=self.task)
+        record_task_end(task_id='task-1', task=self.task, state='SUCCESS')
+        record_task_retry(request=Mock(task=self.task.name))
+
+        task_metrics, = get_task_metrics()
+        self.assertEqual(task_metrics['task_name'], 'apps.general.tasks.some_task')
+        self.assertEqual(task_metrics['runtime_ms']['count'], 1)
+        self.assertGreaterEqual(task_metrics['queue_wait_ms']['avg'], 2000)
+        self.assertEqual((task_metrics['success'], task_metrics['retry']), (1, 1))
+        mock_logstash_logger.warning.assert_called_once_with('Slow celery task apps.general.tasks.some_task', extra=ANY)
+
+    def test_merges_metrics_of_worker_processes(self):
+        cache.clear()
+        worker_process = MetricsRegistry()
+        with patch('apps.general.metrics.os.getpid', return_value=-1):
+            worker_process.observe('%s%s.runtime_ms' % (TASK_METRICS_PREFIX, self.task.name), 100)
+            worker_process.increment('%s%s.success' % (TASK_METRICS_PREFIX, self.task.name))
+        record_task_start(task_id='task-1', task=self.task)
+        record_task_end(task_id='task-1', task=self.task, state='SUCCESS')
+
+        task_metrics, = get_task_metrics()
+        self.assertEqual(task_metrics['runtime_ms']['count'], 2)
+        self.assertEqual(task_metrics['success'], 2)
+
+
+@patch('apps.general.celery._workers_available_until', 0)
+class WorkersAvailableTests(SimpleTestCase):
+    def setUp(self):
+        cache.delete_many([WORKER_HEARTBEAT_CACHE_KEY, WORKERS_AVAILABLE_CACHE_KEY])
+
+    @patch('apps.general.celery.current_app')
+    def test_caches_ping_result(self, mock_app):
+        mock_app.control.ping.return_value = [{'celery@host': {'ok': 'pong'}}]
+        self.assertTrue(workers_available())
+        self.assertTrue(workers_available())
+        mock_app.control.ping.assert_called_once_with(timeout=ANY, limit=1)
+
+    @patch('apps.general.celery.current_app')
+    def test_positive_answer_is_kept_in_the_process(self, mock_app):
+        mock_app.control.ping.return_value = [{'celery@host': {'ok': 'pong'}}]
+        self.assertTrue(workers_available())
+        with patch('apps.general.celery.cache') as mock_cache:
+            self.assertTrue(workers_available())
+        mock_cache.get.assert_not_called()
+
+    @patch('apps.general.celery.current_app')
+    def test_negative_answer_is_not_kept_in_the_process(self, mock_app):
+        mock_app.control.ping.return_value = []
+        self.assertFalse(workers_available())
+        cache.set(WORKER_HEARTBEAT_CACHE_KEY, time.time())
+        self.assertTrue(workers_available())
+
+    @patch('apps.general.celery.current_app')
+    @patch('apps.general.celery._heartbeat_stored_at', 0)
+    def test_worker_heartbeat_skips_ping(self, mock_app):
+        store_worker_heartbeat()
+        self.assertTrue(workers_available())
+        mock_app.control.ping.assert_not_called()
+
+
+class WMCPDatabaseBackendTests(TestCase):
+    def setUp(self):
+        self.backend = WMCPDatabaseBackend(app=current_app)
+        self.request = Mock(task='apps.general.tasks.some_task', children=[])
+
+    @override_settings(CELERY_RESULT_BUFFER_SIZE=2, CELERY_RESULT_BUFFER_FLUSH_INTERVAL=60)
+    def test_stores_buffered_results_in_bulk(self):
+        self.backend._store_result('task-1', 1, 'SUCCESS', request=self.request)
+        self.assertFalse(TaskResult.objects.exists())
+        self.backend._store_result('task-2', 2, 'SUCCESS', request=self.request)
+        self.assertEqual(set(TaskResult.objects.values_list('task_id', flat=True)), {'task-1', 'task-2'})
+        self.assertEqual(TaskResultName.objects.filter(task_name='apps.general.tasks.some_task').count(), 2)
+
+    def test_stores_result_and_name_without_selects(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.backend._store_result('task-1', None, 'STARTED', request=self.request)
+            self.backend._store_result('task-1', 1, 'SUCCESS', request=self.request)
+        self.assertFalse([q for q in queries.captured_queries if q['sql'].startswith('SELECT')])
+        self.assertEqual(TaskResult.objects.get().status, 'SUCCESS')
+        self.assertEqual(TaskResultName.objects.get().task_name, 'apps.general.tasks.some_task')
+
+    @override_settings(CELERY_IGNORE_RESULT_TASKS=('apps.general.tasks.some_task',))
+    def test_skips_fire_and_forget_tasks(self):
+        self.backend._store_result('task-1', 1, 'SUCCESS', request=self.request)
+        self.assertFalse(TaskResult.objects.exists())
+
+    def test_prunes_expired_results_in_chunks(self):
+        for task_id in ('old-1', 'old-2', 'new'):
+            self.backend._store_result(task_id, 1, 'SUCCESS', request=self.request)
+        expired_at = DateUtils.utc_now() - datetime.timedelta(seconds=config.CELERY_TASK_RESULT_EXPIRES + 1)
+        TaskResult.objects.filter(task_id__startswith='old').update(date_done=expired_at)
+
+        self.assertEqual(prune_task_results(chunk_size=1), 2)
+        self.assertEqual(list(TaskResult.objects.values_list('task_id', flat=True)), ['new'])
+        self.assertEqual(TaskResultName.objects.count(), 1)
+
+
 class DateUtilsTests(TestCase):
 
     @classmethod
@@ -26,4 +26,5 @@ urlpatterns = [
     re_path(r'^ettaSF$(?i)', RedirectView.as_view(url=reverse_lazy('account:login'))),
     url(r'^raise_exception', views.raise_exception, name='raise_exception'),  # for internal (developers) use
     url(r'^return-200', views.return_200, name='return-200'),  # for internal devops use
+    url(r'^metrics$', views.metrics, name='metrics'),  # for internal (developers) use
 ]
@@ -27,9 +27,11 @@ from django.core import serializers
 from django.core.management import call_command
 from django.db import models
 from django.db.models.base import ModelBase
+from django.db.models.query import ModelIterable
 from django.db.models.manager import Manager
 from django.db.models.fields.related import ManyToManyField
 from django.forms.models import model_to_dict
+from django.http import StreamingHttpResponse
 from phonenumber_field.formfields import PhoneNumberField
 from recurrence import Weekday, Recurrence
 from tinymce import models as tinymce_models
@@ -305,6 +307,15 @@ def nth_item(iterable, n, default=None):
     return next(islice(iterable, n, None), default)
 
 
+def chunked(iterable, size):
+    """ Yields lists of up to `size` items without generating of entire sequence """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
 def clone_model_fields(src, dest):
     """ Clones the src model into dest """
     m2m_fields = [f.name for f in src._meta.get_fields() if isinstance(f, ManyToManyField)]
@@ -559,12 +570,54 @@ def get_text_recurrence_rrules(rec: Recurrence) -> str:
     return '; '.join(text_rules)
 
 
-def csv_value_from_dict(headers: List[str], data: List[dict]) -> str:
+def iter_csv(headers: List[str], rows, chunk_size=None, encoding='utf-8'):
+    """
+    Yields the CSV encoded, per `chunk_size` (settings.CSV_EXPORT_CHUNK_SIZE) rows, so the memory doesn't grow
+    with the row count. Rows are dicts, lists or tuples in the order of `headers`, or single values if there is
+    one header; a queryset is read with `.iterator(chunk_size=...)`, one of model instances as
+    `.values_list(*headers)`, so the headers are its field names then.
+    """
+    chunk_size = chunk_size or getattr(settings, 'CSV_EXPORT_CHUNK_SIZE', 2000)
+    if isinstance(rows, models.QuerySet):
+        if issubclass(rows._iterable_class, ModelIterable):
+            rows = rows.values_list(*headers)
+        rows = rows.iterator(chunk_size=chunk_size)
     output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=headers)
-    writer.writeheader()
-    writer.writerows(data)
-    return output.getvalue()
+    writer = csv.writer(output)
+    dict_writer = csv.DictWriter(output, fieldnames=headers)
+    dict_writer.writeheader()
+    for chunk in chunked(rows, chunk_size):
+        for row in chunk:
+            if isinstance(row, dict):
+                dict_writer.writerow(row)
+            elif isinstance(row, (list, tuple)):
+                writer.writerow(row)
+            elif len(headers) == 1 and not isinstance(row, models.Model):  # e.g. of `.values_list(flat=True)`
+                writer.writerow([row])
+            else:
+                raise TypeError('CSV rows must be dicts, lists or tuples, got %s' % type(row).__name__)
+        yield output.getvalue().encode(encoding)
+        output.seek(0)
+        output.truncate()
+    if output.tell():  # no rows, just the header
+        yield output.getvalue().encode(encoding)
+
+
+def csv_streaming_response(filename: str, headers: List[str], rows, chunk_size=None):
+    response = StreamingHttpResponse(iter_csv(headers, rows, chunk_size), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def write_csv(file, headers: List[str], rows, chunk_size=None):
+    """ Writes the CSV into a file opened in binary mode """
+    for chunk in iter_csv(headers, rows, chunk_size):
+        file.write(chunk)
+
+
+def csv_value_from_dict(headers: List[str], data: List[dict]) -> str:
+    """ The whole CSV as one string, use `iter_csv` for exports that can be large """
+    return b''.join(iter_csv(headers, data)).decode('utf-8')
 
 
 def admin_url_from_object(db_obj: ModelBase):
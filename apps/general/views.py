@@ -1,12 +1,14 @@
 import json
 
-from django.http.response import HttpResponseBadRequest, HttpResponse
+from django.http.response import HttpResponseBadRequest, HttpResponse, JsonResponse
 from django.shortcuts import redirect
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
+from apps.general.decorators import is_staff_or_superuser
 from apps.general.exceptions import ErrorDto
+from apps.general.metrics import get_published_metrics
 from apps.general.utils import redirect_to_marketing_site
 
 
@@ -45,3 +47,10 @@ def raise_exception(request):
 def return_200(request):
     """ Used in devops to monitor if the backend is up and running """
     return HttpResponse('ok')
+
+
+@is_staff_or_superuser
+def metrics(request):
+    """ In-process metrics of all processes, see `apps.general.metrics`. Use ?prefix=graphql.resolver. to filter """
+    return JsonResponse(get_published_metrics(request.GET.get('prefix', '')), safe=False,
+                        json_dumps_params={'indent': 2, 'sort_keys': True})
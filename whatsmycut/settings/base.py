@@ -297,13 +297,53 @@ LOGGING = {
     },
 }
 
+# CACHES
+# https://docs.djangoproject.com/en/dev/ref/settings/#caches
+# Shared by the gunicorn and celery processes: worker heartbeats, published metrics and the dynamic settings version
+# need to be seen by all of them. The tables are made by `createcachetable`. The hot paths don't read them on every
+# call, see CELERY_WORKER_AVAILABILITY_MEMO and DYNAMIC_SETTINGS_VERSION_CHECK_INTERVAL.
+# Once a table holds MAX_ENTRIES keys, a set deletes a third of them, so the GraphQL response cache and the
+# registered persisted queries, whose key counts depend on the clients, have a table of their own (GRAPHQL_CACHE).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    'graphql': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'graphql_cache',
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+}
+
 # EMAIL
 # https://docs.djangoproject.com/en/dev/ref/settings/#email-backend
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 ERROR_EMAIL_THROTTLING_TIME = 30  # seconds
+ERROR_REPORT_MAX_URLS = 50  # most frequent normalized urls kept per error report
+ERROR_REPORT_FLUSH_INTERVAL = 10  # seconds error occurrences are aggregated in-process before being stored, 0 = at once
+ERROR_EMAIL_ASYNC = True  # render and send error emails from a background thread
+ERROR_EMAIL_QUEUE_SIZE = 100  # error emails waiting for the background thread, the ones above are dropped
+ERROR_EMAIL_DIGEST_WINDOW = None  # seconds; when set, the admins get one summary email per window instead
+MANDRILL_BATCH_SIZE = 1000  # recipients per Mandrill API call, see `MandrillEmailer.send_template_batch`
+TWILIO_BULK_WORKERS = 4  # threads sending the messages of `TwilioSMSSender.send_sms_bulk`
+TWILIO_MESSAGES_PER_SECOND = 10  # keep within the account's/messaging services' Twilio rate limit
+EXPO_PUSH_BATCH_SIZE = 100  # push messages per Expo API call, the maximum Expo accepts
+# Notification outbox, see `apps.general.outbox`
+NOTIFICATION_OUTBOX_CONCURRENCY = {'email': 4, 'sms': 4, 'push': 2}  # threads sending each channel
+NOTIFICATION_OUTBOX_BATCH_SIZE = 100  # notifications claimed per channel at once
+NOTIFICATION_OUTBOX_LEASE = 300  # seconds a claimed notification isn't sent by other workers
+NOTIFICATION_OUTBOX_MAX_ATTEMPTS = 6
+NOTIFICATION_OUTBOX_RETRY_DELAY = 30  # seconds before the 1st retry, doubled for every next one
+NOTIFICATION_OUTBOX_MAX_RETRY_DELAY = 3600
+NOTIFICATION_OUTBOX_DRAIN_INTERVAL = 60  # seconds between the periodic drains by celery beat
+EMAIL_MASS_CHUNK_SIZE = 100  # emails built and sent at once by `Emailer.send_mass_email`
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 
+CSV_EXPORT_CHUNK_SIZE = 2000  # rows fetched and encoded at once by `apps.general.utils.iter_csv`
+
 SUBSCRIPTION_TRIAL_MONTHS = 1
 SUBSCRIPTION_LEEWAY_DAYS = 2
 SUBSCRIPTION_COST = 29
@@ -314,6 +354,28 @@ PAYMENT_CURRENCY = 'usd'
 GRAPHENE = {
     'SCHEMA': 'apps.api_gateway.schema.schema'
 }
+GRAPHQL_DOCUMENT_CACHE_SIZE = 500  # parsed & validated query documents kept per process
+GRAPHQL_CACHE = 'graphql'  # CACHES alias of the response cache and the registered persisted queries
+# JSON {sha256: query} manifest generated by the frontend builds; with it only its queries are served by hash
+GRAPHQL_PERSISTED_QUERIES_FILE = None
+GRAPHQL_PERSISTED_QUERIES_TIMEOUT = 60 * 60 * 24  # seconds an automatically registered query is kept
+GRAPHQL_BATCH_WORKERS = 8  # threads executing batched queries concurrently, per process; 0 = sequential
+GRAPHQL_BATCH_CONCURRENCY = 4  # max operations of a single batch running at the same time
+GRAPHQL_BATCH_DEADLINE = 30  # seconds
+GRAPHQL_MAX_QUERY_COST = 20000  # see `apps.general.graphql.QueryCostAnalyzer`; None = unlimited
+GRAPHQL_MAX_QUERY_DEPTH = 12  # None = unlimited
+GRAPHQL_ENFORCE_QUERY_COST = True  # False = only log over-budget queries
+GRAPHQL_DEFAULT_FIELD_COST = 1
+GRAPHQL_LIST_MULTIPLIER = 10  # assumed size of lists without a `first`/`last`/`limit` argument
+GRAPHQL_FIELD_COSTS = {}  # {'TypeName.fieldName': cost}
+# Add 'apps.general.graphql.ResolverTimingMiddleware' to GRAPHENE['MIDDLEWARE'] to collect per-resolver timings
+GRAPHQL_RESOLVER_TIMING_SAMPLE_RATE = 0.1  # share of requests measured by ResolverTimingMiddleware
+GRAPHQL_SLOW_RESOLVER_MS = 500
+METRICS_PUBLISH_INTERVAL = 60  # seconds, see `apps.general.metrics`
+# Root query fields whose responses are cached, see `apps.general.graphql.ResponseCache`. `models` must list
+# every model the field reads, saving/deleting one of them invalidates the cached responses. E.g.
+# {'siteSettings': {'timeout': 600, 'scope': 'public', 'models': ['database.Constance']}}
+GRAPHQL_RESPONSE_CACHE_FIELDS = {}
 
 SESSION_COOKIE_AGE = 60 * 60 * 24 * 14  # 2 weeks, in seconds
 SESSION_COOKIE_PATH = '/admin'
@@ -364,3 +426,20 @@ CELERY_TASK_ALWAYS_EAGER = False
 CELERY_RESULT_BACKEND = 'wmcp-db'
 CELERY_SEND_EVENTS = True
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers.DatabaseScheduler'
+CELERY_WORKER_AVAILABILITY_TTL = 30  # seconds, see `apps.general.celery.workers_available`
+CELERY_WORKER_PING_TIMEOUT = 0.5  # seconds
+CELERY_WORKER_AVAILABILITY_MEMO = 5  # seconds a process trusts a positive answer without reading the cache
+# Task results are stored in bulk per this many tasks (or per CELERY_RESULT_BUFFER_FLUSH_INTERVAL seconds), 0 = at once
+CELERY_RESULT_BUFFER_SIZE = 0
+CELERY_RESULT_BUFFER_FLUSH_INTERVAL = 5
+CELERY_IGNORE_RESULT_TASKS = ()  # names of fire-and-forget tasks whose results are never stored
+CELERY_RESULT_PRUNE_CHUNK_SIZE = 1000  # see `apps.general.celery.prune_task_results`
+CELERY_SLOW_TASK_MS = 60000  # tasks running longer are logged, see `apps.general.celery.record_task_end`
+# Synced into django_celery_beat's periodic tasks by the DatabaseScheduler
+CELERY_BEAT_SCHEDULE = {
+    # sends what's left when no worker was up to be handed the drain, and the due retries
+    'drain-notification-outbox': {
+        'task': 'apps.general.tasks.drain_notification_outbox',
+        'schedule': NOTIFICATION_OUTBOX_DRAIN_INTERVAL,
+    },
+}
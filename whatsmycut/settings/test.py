@@ -18,7 +18,11 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': '',
-    }
+    },
+    'graphql': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'graphql',
+    },
 }
 
 # https://docs.djangoproject.com/en/dev/ref/settings/#password-hashers
@@ -32,6 +36,10 @@ TEMPLATES[0]['OPTIONS']['debug'] = DEBUG
 EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
 EMAIL_HOST = 'localhost'
 
+# Store error reports right away instead of from a timer thread
+ERROR_REPORT_FLUSH_INTERVAL = 0
+ERROR_EMAIL_ASYNC = False
+
 TEST_OUTPUT_FILE_NAME = 'junit.xml'
 
 logging.disable(logging.CRITICAL)